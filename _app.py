@@ -3,21 +3,57 @@
 import datetime
 import getpass
 import glob
-import globre
-import jinja2
+import hashlib
 import os
+import pickle
 import re
 import sys
-import tempfile
-import yaml
 
-from iterfzf import iterfzf
-from natsort import natsorted
+from _cache import cache_dir, file_signature
+from _timings import lazy_import, span
+
+# parsed configs and inventories kept across requests by the daemon,
+# {key: (signature, value)}, None in a regular run
+warm_cache = None
+
+# discovered directories end up in a shell command, others are dropped
+safe_dir = re.compile(r"/[\w./@%+=:,-]*")
+
+
+# -----------------------------------------------
+# Lazy dependencies
+# -----------------------------------------------
+def iterfzf(*args, **kwargs):
+
+    with span("fzf select", prompt=kwargs.get("prompt", "")):
+        return lazy_import("iterfzf").iterfzf(*args, **kwargs)
+
+
+def get_warm(key, signature):
+
+    if warm_cache is None or key not in warm_cache:
+        return None
+
+    cached_signature, value = warm_cache[key]
+
+    return value if cached_signature == signature else None
+
+
+def set_warm(key, signature, value):
+
+    if warm_cache is not None:
+        warm_cache[key] = (signature, value)
+
 
 # -----------------------------------------------
 # Class
 # -----------------------------------------------
 class App:
+
+    # config files are named *.<config_type>.<extension>
+    config_type = None
+    config_extensions = ["yml"]
+
     def __init__(self, args):
 
         self.appname = "utmx"
@@ -47,10 +83,29 @@ class App:
 
         return config
 
+    def get_config_dirs(self):
+
+        app_config = self.app_config
+
+        config_dirs_found = []
+
+        for path in app_config["config_dirs"]:
+
+            path = os.path.abspath(os.path.expanduser(path))
+
+            if os.path.exists(path):
+                config_dirs_found.append(path)
+
+        if not len(config_dirs_found):
+            sys.exit(f"No config dirs found.")
+
+        print(f"Browse {','.join(app_config['config_dirs'])} directories...")
+
+        return config_dirs_found
+
     def get_cli_config_file(self):
 
         args = self.args
-        app_config = self.app_config
 
         # return cached file
         if self.cli_config_file:
@@ -74,27 +129,20 @@ class App:
 
         else:
             # search paths
-            config_dirs_found = []
-
-            for path in app_config["config_dirs"]:
-
-                path = os.path.abspath(os.path.expanduser(path))
-
-                if os.path.exists(path):
-                    config_dirs_found.append(path)
-
-            if not len(config_dirs_found):
-                sys.exit(f"No config dirs found.")
-
-            print(f"Browse {','.join(app_config['config_dirs'])} directories...")
+            config_dirs_found = self.get_config_dirs()
 
             config_files = []
 
-            config_file_pattern = f"*.{args.subcommand}.yml"
+            config_file_pattern = "*.{}.{{{}}}".format(
+                self.config_type, ",".join(self.config_extensions)
+            )
 
             for path in config_dirs_found:
 
-                config_files += glob.glob(f"{path}/{config_file_pattern}")
+                for extension in self.config_extensions:
+                    config_files += glob.glob(
+                        f"{path}/*.{self.config_type}.{extension}"
+                    )
 
             if not len(config_files):
                 sys.exit(
@@ -131,22 +179,85 @@ class App:
         if file_path in self.yaml_configs:
             return self.yaml_configs[file_path]
 
-        # read the yaml file
-        with open(file_path) as file:
+        if not re.search(r".+\.ya?ml$", file_path):
+            sys.exit("{} file not supported!".format(file_path))
+
+        # return parsed file from daemon or disk cache
+        signature = self.get_file_signature(file_path)
 
-            if re.search(r".+\.ya?ml$", file_path):
+        warm = get_warm(("yaml", file_path), signature)
+
+        if warm is not None:
+            # callers may change the config, hand out a copy
+            yaml_config = pickle.loads(warm)
+        else:
+            with span("yaml cache read", file=file_path):
+                yaml_config = self.read_yaml_cache(file_path, signature)
+
+        if yaml_config is None:
+
+            yaml = lazy_import("yaml")
+
+            # use libyaml when available
+            loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+            # read the yaml file
+            with open(file_path) as file:
                 try:
-                    yaml_config = yaml.load(file, Loader=yaml.SafeLoader)
+                    with span("yaml parse", file=file_path):
+                        yaml_config = yaml.load(file, Loader=loader)
                 except yaml.YAMLError as e:
                     print(e)
                     sys.exit("Exception in parsing yaml file " + file_path + "!")
-            else:
-                sys.exit("{} file not supported!".format(file_path))
+
+            self.write_yaml_cache(file_path, signature, yaml_config)
+
+        if warm is None and warm_cache is not None:
+            set_warm(("yaml", file_path), signature, pickle.dumps(yaml_config))
 
         self.yaml_configs[file_path] = yaml_config
 
         return yaml_config
 
+    def get_yaml_cache_file(self, file_path):
+
+        key = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()
+
+        return os.path.join(cache_dir, "yaml", f"{key}.pickle")
+
+    def get_file_signature(self, file_path):
+
+        return file_signature(file_path)
+
+    def read_yaml_cache(self, file_path, signature):
+
+        try:
+            with open(self.get_yaml_cache_file(file_path), "rb") as file:
+                cached = pickle.load(file)
+
+            if cached["signature"] == signature:
+                return cached["config"]
+        except (OSError, ValueError, EOFError, KeyError, TypeError, pickle.PickleError):
+            pass
+
+        return None
+
+    def write_yaml_cache(self, file_path, signature, yaml_config):
+
+        cache_file = self.get_yaml_cache_file(file_path)
+        cached = {"signature": signature, "config": yaml_config}
+
+        try:
+            os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+
+            # replace atomically for concurrent runs
+            with open(f"{cache_file}.{os.getpid()}", "wb") as file:
+                pickle.dump(cached, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(f"{cache_file}.{os.getpid()}", cache_file)
+        except OSError:
+            pass
+
     def select_sessions(self, yaml_config, session_name="session", multi_select=True):
 
         sessions_available = yaml_config.keys()
@@ -181,68 +292,275 @@ class App:
 
 class GenApp(App):
 
+    config_type = "gen"
+    config_extensions = ["yml", "jsonl"]
+
+    def get_inventory(self):
+
+        args = self.args
+
+        # build the inventory index once per loaded config
+        if hasattr(self, "inventory"):
+            return self.inventory
+
+        inventory = lazy_import("_inventory")
+        file_path = self.get_cli_config_file()
+
+        key = ("inventory", file_path, args.group_match, args.host_match)
+        signature = self.get_file_signature(file_path)
+
+        self.inventory = get_warm(key, signature)
+
+        if self.inventory is not None:
+            return self.inventory
+
+        if file_path.endswith(".jsonl"):
+            # load, filter and index in one pass over the file
+            dir_configs = []
+            with span("jsonl load", file=file_path):
+                self.inventory = inventory.Inventory(
+                    inventory.read_jsonl(file_path, dir_configs),
+                    self.is_valid_host,
+                    dir_configs,
+                    args.group_match,
+                    args.host_match,
+                )
+        else:
+            yaml_config = self.read_yaml_config(file_path)
+            self.inventory = inventory.Inventory(
+                yaml_config["hosts"],
+                self.is_valid_host,
+                yaml_config.get("dirs") or [],
+                args.group_match,
+                args.host_match,
+            )
+
+        set_warm(key, signature, self.inventory)
+
+        return self.inventory
+
+    def iter_host_choices(self, group_config, host_groups):
+
+        inventory = self.get_inventory()
+
+        # merge the sorted groups, skip hosts in several groups
+        hosts = lazy_import("heapq").merge(
+            *[group_config[g] for g in host_groups], key=inventory.get_rank
+        )
+
+        previous = None
+
+        for host in hosts:
+
+            if host == previous:
+                continue
+
+            previous = host
+            description = inventory.get_host(host).get("description", "")
+
+            yield f"{host}; {description}"
+
+    def discover_dirs(self, hosts):
+
+        ssh = lazy_import("_ssh")
+        cache = lazy_import("_cache")
+
+        config = self.app_config.get("dir_discovery") or {}
+        roots = config.get("roots", ["/var/log", "/opt", "/srv", "/etc"])
+        depth = config.get("depth", 1)
+
+        # -----------------------------------------------
+        # Use cached results per host
+        # -----------------------------------------------
+        dirs_cache = cache.JsonCache("dirs", config.get("ttl", 3600))
+        cached = dirs_cache.items()
+
+        def cache_key(host):
+            return f"{host}:{depth}:{','.join(roots)}"
+
+        dirs = {h: cached[cache_key(h)] for h in hosts if cache_key(h) in cached}
+        missing = [h for h in hosts if h not in dirs]
+
+        # -----------------------------------------------
+        # List directories on the other hosts
+        # -----------------------------------------------
+        if missing:
+            print(f"Discover directories on {len(missing)} host(s)...")
+
+            options = []
+            if self.app_config.get("ssh_multiplex"):
+                ssh.cleanup_control_sockets()
+                options = ssh.multiplex_options(
+                    self.app_config.get("ssh_multiplex_persist", "60s")
+                )
+
+            results = ssh.discover_dirs(
+                missing,
+                roots,
+                depth,
+                config.get("timeout", 10),
+                config.get("workers", 16),
+                options,
+            )
+
+            for host, host_dirs in results.items():
+                if host_dirs is None:
+                    print(host.ljust(60, "."), "FAIL")
+                else:
+                    dirs[host] = host_dirs
+
+            dirs_cache.update({cache_key(h): dirs[h] for h in missing if h in dirs})
+
+        return [
+            d for host in hosts for d in dirs.get(host, []) if safe_dir.fullmatch(d)
+        ]
+
     def get_group_config(self):
 
-        yaml_config = self.read_yaml_config(self.get_cli_config_file())
+        return self.get_inventory().select(self.args.group_match, self.args.host_match)
+
+    def get_host_config(self, host):
+
+        host_config = self.get_inventory().get_host(host)
+
+        if host_config is None:
+            sys.exit("Illegal host. Not found.")
 
-        hosts = []
-        for config in yaml_config['hosts']:
+        return host_config
+
+    def run_headless(self):
+
+        args = self.args
+
+        ssh = lazy_import("_ssh")
+
+        if not args.shell:
+            sys.exit("Headless mode requires --shell!")
+
+        # all matched hosts in natural order, no panes and no selection
+        inventory = self.get_inventory()
+        group_config = self.get_group_config()
+
+        hosts = sorted(
+            set(h for group_hosts in group_config.values() for h in group_hosts),
+            key=inventory.get_rank,
+        )
+
+        if not hosts:
+            sys.exit("No hosts found!")
+
+        workers = args.concurrency or self.app_config.get("headless_workers", 32)
+        timeout = args.timeout or self.app_config.get("headless_timeout", 60)
+
+        options = []
+        if self.app_config.get("ssh_multiplex"):
+            ssh.cleanup_control_sockets()
+            options = ssh.multiplex_options(
+                self.app_config.get("ssh_multiplex_persist", "60s")
+            )
 
-            config2 = config.copy()
-            if 'groups' not in config:
-                config2['groups'] = ['<none>', '<all>']
+        # -----------------------------------------------
+        # Stream prefixed output
+        # -----------------------------------------------
+        width = max(len(h) for h in hosts)
+        lock = lazy_import("threading").Lock()
+
+        def on_line(host, line):
+            with lock:
+                print(host.ljust(width), "|", line, flush=True)
+
+        print(f"Run on {len(hosts)} host(s), {workers} at a time...")
+
+        start = lazy_import("time").monotonic()
+
+        results = ssh.run_destinations(
+            hosts, args.shell, timeout, workers, options, on_line
+        )
+
+        # -----------------------------------------------
+        # Summary
+        # -----------------------------------------------
+        print()
+
+        failed = 0
+
+        for host, (returncode, duration) in results.items():
+
+            if returncode is None:
+                status = "TIMEOUT"
+            elif returncode == 255:
+                status = "SSH FAIL"
             else:
-                config2['groups'] = config['groups']
-                if '<all>' not in config['groups']:
-                    config2['groups'].append('<all>')
+                status = "OK" if returncode == 0 else f"EXIT {returncode}"
 
-            hosts.append(config2)
+            if status != "OK":
+                failed += 1
 
-        yaml_config['hosts'] = hosts
+            print(host.ljust(60, "."), status.ljust(8), "{:.2f}s".format(duration))
 
-        groups = {}
+        print()
+        print(
+            "{} ok, {} failed in {:.2f}s".format(
+                len(hosts) - failed,
+                failed,
+                lazy_import("time").monotonic() - start,
+            )
+        )
 
-        for config in yaml_config["hosts"]:
+        return 1 if failed else 0
 
-            if "groups" in config:
+    def plan_windows(self, hosts):
 
-                for group in config["groups"]:
+        args = self.args
 
-                    if self.args.group_match:
+        panes_per_window = args.panes_per_window or self.app_config.get(
+            "panes_per_window", 9
+        )
 
-                        if not globre.match(self.args.group_match, group):
-                            continue
+        if panes_per_window < 1:
+            sys.exit("Panes per window must be at least 1!")
 
-                    if self.args.host_match:
-                        if not globre.match(self.args.host_match, config["host"]):
-                            continue
+        # -----------------------------------------------
+        # Bucket hosts by window prefix
+        # -----------------------------------------------
+        # group by the first inventory group of a host, keep selection order
+        buckets = {}
 
-                    if group not in groups:
-                        groups[group] = {}
+        for host in hosts:
+            if args.group_windows:
+                prefix = self.get_host_config(host)["groups"][0]
+            else:
+                prefix = "hosts"
 
-                    groups[group][config["host"]] = config
+            buckets.setdefault(prefix, []).append(host)
 
-        return groups
+        # -----------------------------------------------
+        # Page buckets into windows
+        # -----------------------------------------------
+        windows = []
 
-    def get_host_config(self, host):
+        for prefix, bucket_hosts in buckets.items():
 
-        host_config = {}
+            pages = [
+                bucket_hosts[i : i + panes_per_window]
+                for i in range(0, len(bucket_hosts), panes_per_window)
+            ]
 
-        host_configs = self.read_yaml_config(self.get_cli_config_file())["hosts"]
+            for page, page_hosts in enumerate(pages, 1):
 
-        for host_config in host_configs:
+                name = prefix if len(pages) == 1 else f"{prefix}-{page}"
+                windows.append({"name": name, "hosts": page_hosts})
 
-            if host_config["host"] == host:
-                return host_config
+        # spread panes evenly, one row per pane runs out of space quickly
+        for window in windows:
+            window["tiled"] = len(window["hosts"]) > 1
 
-        sys.exit("Illegal host. Not found.")
+        return windows
 
     def get_session_config(self, session_name):
 
         args = self.args
 
-        yaml_config = self.read_yaml_config(self.get_cli_config_file())
-
         group_config = self.get_group_config()
 
         if not len(group_config):
@@ -271,31 +589,10 @@ class GenApp(App):
         # -----------------------------------------------
         # Select hosts
         # -----------------------------------------------
-        choices_list = []
-
-        for host_group in host_groups:
-
-            for host in group_config[host_group]:
-
-                host_config = group_config[host_group][host]
-                description = ''
-
-                if "description" in host_config:
-                    description = host_config["description"]
-
-                if not self.is_valid_host(host) or host[-1] == ".":
-                    sys.exit(f"Illegal host: '{host}'")
-
-                choices_list.append(f"{host}; {description}")
-
-        # remove empty
-        choices_list = list(set(filter(None, choices_list)))
-
-        # sort
-        choices_list = natsorted(choices_list)
-
+        # hosts are validated and sorted when the inventory is loaded,
+        # choices are streamed so fzf shows up right away
         hosts0 = iterfzf(
-            choices_list,
+            self.iter_host_choices(group_config, host_groups),
             multi=True,
             exact=True,
             prompt="Select (multiple with tab/shift+tab) server(s):",
@@ -310,9 +607,6 @@ class GenApp(App):
         if not len(hosts0):
             sys.exit("Select a host!")
 
-        if len(hosts0) > 9:
-            sys.exit("Max number is 9!")
-
         hosts_selected = []
         for entry in hosts0:
             hosts_selected.append(entry.split(";")[0].strip())
@@ -341,14 +635,11 @@ class GenApp(App):
                         sys.exit("Illegal host config!")
 
                     # check for dir patterns
-                    for dir_config in yaml_config["dirs"]:
-
-                        for pattern in dir_config["group_match"]:
+                    sel_dirs.extend(self.get_inventory().get_dirs(host_selected))
 
-                            for group in host_config["groups"]:
-
-                                if globre.match(pattern, group):
-                                    sel_dirs.extend(dir_config["paths"])
+                # merge with directories found on the hosts
+                if args.discover:
+                    sel_dirs.extend(self.discover_dirs(hosts_selected))
 
                 sel_dirs = list(dict.fromkeys(sel_dirs))
 
@@ -370,10 +661,10 @@ class GenApp(App):
                 sys.exit(f"Illegal dir '{directory}'!")
 
         # -----------------------------------------------
-        # Create template
+        # Create session config
         # -----------------------------------------------
         data = {}
-        data["hosts"] = hosts_selected
+        data["windows"] = self.plan_windows(hosts_selected)
         data["session_name"] = session_name
         data["created_by"] = self.run_username
         data["created_ts"] = self.script_time
@@ -385,7 +676,57 @@ class GenApp(App):
         data["synchronize"] = args.sync
         data["tiled"] = args.tiled
 
+        if args.debug:
+            print(self.render_session_config(data))
+            sys.exit()
+
+        if args.save_config:
+            print(f"Write config to {args.save_config}...")
+
+            with open(args.save_config, "w") as f:
+                f.write(self.render_session_config(data))
+
+        return self.build_session_config(data)
+
+    def build_session_config(self, data):
+
+        # same structure as generated_config.j2, built in memory
+        session_config = {}
+
+        if data["tiled"]:
+            session_config["layout"] = "tiled"
+
+        session_config["synchronize"] = bool(data["synchronize"])
+        session_config["windows"] = []
+
+        for window in data["windows"]:
+
+            window_config = {"name": window["name"]}
+
+            if window["tiled"]:
+                window_config["layout"] = "tiled"
+
+            window_config["panes"] = []
+
+            for host in window["hosts"]:
+
+                pane = {"ssh": {"server": host}}
+
+                if data.get("shell_cmd"):
+                    pane["shell"] = data["shell_cmd"]
+                if data.get("directory"):
+                    pane["dir"] = data["directory"]
+
+                window_config["panes"].append(pane)
+
+            session_config["windows"].append(window_config)
+
+        return session_config
+
+    def render_session_config(self, data):
+
         template_file = "generated_config.j2"
+        jinja2 = lazy_import("jinja2")
         templateLoader = jinja2.FileSystemLoader(searchpath=self.script_dir)
         templateEnv = jinja2.Environment(loader=templateLoader)
         template = templateEnv.get_template(template_file)
@@ -394,31 +735,141 @@ class GenApp(App):
         )  # this is where to put args to the template renderer
 
         # remove blank lines
-        config = "".join([s for s in config.splitlines(True) if s.strip("\r\n")])
-        if args.debug:
-            print(config)
-            sys.exit()
+        return "".join([s for s in config.splitlines(True) if s.strip("\r\n")])
+
 
-        # create temp file
-        tmp_file = tempfile.NamedTemporaryFile(suffix=".yml", delete=False)
-        print(f"Write config to {tmp_file.name}...")
+class RunApp(App):
 
-        # Open the file for writing.
-        with open(tmp_file.name, "w") as f:
-            f.write(config)
+    config_type = "run"
 
-        return self.read_yaml_config(tmp_file.name)[session_name]
+    def get_session_index(self):
 
+        # session name -> config file over all config dirs
+        if not hasattr(self, "session_index"):
+            self.session_index = lazy_import("_sessions").SessionIndex(
+                self.get_config_dirs(), f"*.{self.config_type}.yml"
+            )
+            self.session_index.refresh()
 
-class RunApp(App):
-    def get_session_config(self, session_name):
+        return self.session_index
+
+    def list_sessions(self):
+
+        if self.args.config_file:
+            file_path = self.get_cli_config_file()
+            sessions = [(s, file_path) for s in self.read_yaml_config(file_path)]
+        else:
+            sessions = self.get_session_index().sessions()
+
+        for session_name, file_path in sessions:
+            print(str(session_name).ljust(40), file_path)
+
+    def get_indexed_session_configs(self, session_names):
+
+        index = self.get_session_index()
+
+        # -----------------------------------------------
+        # Find the config file of each session
+        # -----------------------------------------------
+        if session_names:
+            selected = []
+
+            for session_name in session_names:
+
+                file_paths = index.find(session_name)
+
+                if not file_paths:
+                    sys.exit(f"{session_name} not found!")
+
+                if len(file_paths) > 1:
+                    sys.exit(
+                        f"{session_name} found in {', '.join(file_paths)}, use -c!"
+                    )
+
+                selected.append((session_name, file_paths[0]))
+        else:
+            choices = [f"{s}; {f}" for s, f in index.sessions()]
+
+            if not choices:
+                sys.exit(f"No sessions found in '*.{self.config_type}.yml' files!")
+
+            entries = iterfzf(
+                choices,
+                multi=True,
+                exact=True,
+                prompt="Select a session:",
+            )
+
+            if not entries:
+                sys.exit("Illegal selection!")
+
+            selected = [tuple(entry.split("; ", 1)) for entry in entries]
+
+        # -----------------------------------------------
+        # Parse only the session blocks
+        # -----------------------------------------------
+        session_configs = {}
+
+        for session_name, file_path in selected:
+
+            print(f"Use config file '{file_path}'...")
+
+            session_config = index.load(file_path, session_name)
+
+            # anchors or unusual keys need the whole document
+            if session_config is None:
+                session_config = self.read_yaml_config(file_path).get(session_name)
+
+            if session_config is None:
+                sys.exit(f"{session_name} not found!")
+
+            session_configs[session_name] = session_config
+
+        return session_configs
+
+    def get_session_configs(self, session_names):
+
+        # without a config file sessions are looked up in the index
+        if not self.args.config_file:
+            return self.get_indexed_session_configs(session_names)
 
         yaml_config = self.read_yaml_config(self.get_cli_config_file())
 
-        if not session_name:
-            session_name = self.select_sessions(yaml_config, "session", False)[0]
+        if not session_names:
+            session_names = self.select_sessions(yaml_config, "session", True)
+
+        session_configs = {}
 
-        if not session_name:
-            sys.exit("Illegal session name!")
+        for session_name in session_names:
 
-        return yaml_config[session_name]
+            if not session_name in yaml_config:
+                sys.exit(f"{session_name} not found!")
+
+            session_configs[session_name] = yaml_config[session_name]
+
+        return session_configs
+
+
+class ConvertApp(App):
+
+    config_type = "gen"
+
+    def convert(self):
+
+        file_path = self.get_cli_config_file()
+
+        yaml_config = self.read_yaml_config(file_path)
+
+        if not isinstance(yaml_config, dict) or "hosts" not in yaml_config:
+            sys.exit(f"No hosts found in {file_path}!")
+
+        output = self.args.output or re.sub(r"\.ya?ml$", ".jsonl", file_path)
+
+        if output == file_path:
+            sys.exit("Output file must differ from the config file!")
+
+        print(f"Write {len(yaml_config['hosts'])} hosts to {output}...")
+
+        lazy_import("_inventory").write_jsonl(
+            output, yaml_config["hosts"], yaml_config.get("dirs") or []
+        )
@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+
+import contextlib, fcntl, json, os, time
+
+from _timings import lazy_import
+
+cache_dir = os.path.expanduser("~/.ultimux/cache")
+
+
+def file_signature(file_path):
+
+    # changes whenever a file is modified or replaced
+    stat = os.stat(file_path)
+
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+class JsonCache:
+
+    # -----------------------------------------------
+    # Json file shared between concurrent runs
+    # -----------------------------------------------
+    # entries are stored as {key: {"ts": epoch, "value": value}} and
+    # expire after ttl seconds, writes are serialized with flock
+
+    def __init__(self, name, ttl=300):
+
+        self.path = os.path.join(cache_dir, name + ".json")
+        self.ttl = ttl
+
+    @contextlib.contextmanager
+    def lock(self):
+
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(data, dict):
+            return {}
+
+        return data
+
+    def save(self, data):
+
+        # replace atomically so readers never see a partial file
+        fd, tmp_path = lazy_import("tempfile").mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(data, file)
+
+        os.replace(tmp_path, self.path)
+
+    def items(self):
+
+        if self.ttl <= 0:
+            return {}
+
+        now = time.time()
+
+        return {
+            k: v.get("value")
+            for k, v in self.load().items()
+            if isinstance(v, dict) and now - v.get("ts", 0) <= self.ttl
+        }
+
+    def get(self, key):
+
+        return self.items().get(key)
+
+    def update(self, values):
+
+        if self.ttl <= 0 or not values:
+            return
+
+        now = time.time()
+
+        with self.lock():
+            data = self.load()
+
+            # drop expired entries
+            data = {
+                k: v
+                for k, v in data.items()
+                if isinstance(v, dict) and now - v.get("ts", 0) <= self.ttl
+            }
+
+            for key, value in values.items():
+                data[key] = {"ts": now, "value": value}
+
+            self.save(data)
@@ -0,0 +1,400 @@
+#! /usr/bin/env python3
+
+import json, os, queue, select, signal, socket, sys, threading, time, traceback
+
+from _timings import lazy_import
+
+base_dir = os.path.expanduser("~/.ultimux")
+socket_path = os.path.join(base_dir, "daemon.sock")
+pid_path = os.path.join(base_dir, "daemon.pid")
+log_path = os.path.join(base_dir, "daemon.log")
+
+# client environment applied to each request
+client_env = [
+    "COLUMNS",
+    "HOME",
+    "LANG",
+    "LINES",
+    "PATH",
+    "SSH_AUTH_SOCK",
+    "TERM",
+    "TMUX",
+    "TMUX_TMPDIR",
+    "USER",
+]
+
+
+# -----------------------------------------------
+# Messages
+# -----------------------------------------------
+# one json object per line, the first client message carries the stdin,
+# stdout and stderr of the client (SCM_RIGHTS), so output and prompts of
+# a request go straight to the client terminal
+def send(sock, message):
+
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+
+def connect():
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+
+    return sock
+
+
+# -----------------------------------------------
+# Client
+# -----------------------------------------------
+def request(argv):
+
+    # None when no daemon is running, it is busy or the request needs
+    # to run in the client process (terminal prompts)
+    sock = connect()
+
+    if sock is None:
+        return None
+
+    with sock:
+        message = {
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": {k: os.environ[k] for k in client_env if k in os.environ},
+        }
+
+        sys.stdout.flush()
+        socket.send_fds(sock, [json.dumps(message).encode() + b"\n"], [0, 1, 2])
+
+        reader = sock.makefile("r")
+
+        def choices():
+            for line in reader:
+                message = json.loads(line)
+                if "choice" not in message:
+                    return
+                yield message["choice"]
+
+        try:
+            for line in reader:
+
+                message = json.loads(line)
+
+                # fzf runs on the client terminal, choices are streamed
+                if "select" in message:
+                    stream = choices()
+                    selected = lazy_import("_app").iterfzf(stream, **message["select"])
+
+                    # fzf may quit before all choices arrived
+                    for _ in stream:
+                        pass
+
+                    send(sock, {"selected": selected})
+
+                elif message.get("busy") or message.get("local"):
+                    return None
+
+                elif "exit" in message:
+                    return message
+        except KeyboardInterrupt:
+            # closing the connection cancels the request in the daemon
+            return {"exit": 130}
+
+    return {"exit": 1}
+
+
+def stop():
+
+    try:
+        with open(pid_path) as file:
+            pid = int(file.read())
+
+        os.kill(pid, signal.SIGTERM)
+    except (OSError, ValueError):
+        sys.exit("Ultimux daemon is not running!")
+
+    print(f"Stop ultimux daemon ({pid})...")
+
+
+def status():
+
+    sock = connect()
+
+    if sock is None:
+        sys.exit("Ultimux daemon is not running!")
+
+    with sock:
+        send(sock, {"status": True})
+        reply = json.loads(sock.makefile("r").readline())
+
+    print(
+        "Ultimux daemon ({}) up {:.0f}s, {} request(s), {} cached configs".format(
+            reply["pid"], reply["uptime"], reply["requests"], reply["cached"]
+        )
+    )
+
+
+# -----------------------------------------------
+# Server
+# -----------------------------------------------
+class Daemon:
+
+    # requests run one at a time with the client's terminal, a busy
+    # daemon sends clients back to run in their own process. Requests
+    # run in the main thread, so a client that goes away (Ctrl-C) can
+    # interrupt them like a KeyboardInterrupt in process
+
+    def __init__(self, handler):
+
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.running = False
+        self.requests = 0
+        self.started = time.time()
+
+    def serve(self):
+
+        os.makedirs(base_dir, mode=0o700, exist_ok=True)
+
+        # a stale socket refuses connections
+        if connect() is not None:
+            sys.exit("Ultimux daemon is already running!")
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        server.listen()
+
+        with open(pid_path, "w") as file:
+            file.write(str(os.getpid()))
+
+        # configs and inventories are kept across requests
+        lazy_import("_app").warm_cache = {}
+
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+        # cancels the running request, SIGINT still stops a foreground daemon
+        signal.signal(signal.SIGUSR1, self.interrupt)
+
+        threading.Thread(target=self.accept, args=(server,), daemon=True).start()
+
+        try:
+            while True:
+                self.jobs.get()()
+        finally:
+            server.close()
+            os.unlink(socket_path)
+            os.unlink(pid_path)
+
+    def accept(self, server):
+
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def interrupt(self, *_):
+
+        # only a running request is cancelled
+        if self.running:
+            raise KeyboardInterrupt
+
+    def handle(self, conn):
+
+        fds = []
+
+        with conn:
+            try:
+                data, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+
+                while not data.endswith(b"\n"):
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        return
+                    data += chunk
+
+                message = json.loads(data)
+
+                if message.get("status"):
+                    send(conn, self.get_status())
+                elif len(fds) != 3:
+                    send(conn, {"exit": 1})
+                elif not self.lock.acquire(blocking=False):
+                    send(conn, {"busy": True})
+                else:
+                    try:
+                        send(conn, self.run_main(conn, message, fds))
+                    finally:
+                        self.lock.release()
+            except BrokenPipeError:
+                # the client went away
+                pass
+            except (OSError, ValueError):
+                traceback.print_exc()
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+    def run_main(self, conn, message, fds):
+
+        # -----------------------------------------------
+        # Run in the main thread, cancel on hang up
+        # -----------------------------------------------
+        done = threading.Event()
+        result = {}
+
+        def job():
+            try:
+                result.update(self.run(conn, message, fds))
+            finally:
+                done.set()
+
+        self.jobs.put(job)
+
+        poll = select.poll()
+        poll.register(conn, select.POLLRDHUP)
+
+        while not done.is_set():
+            if not poll.poll(200):
+                continue
+
+            # a request about to start is cancelled once it runs
+            if not self.running:
+                done.wait(0.05)
+                continue
+
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGUSR1)
+            done.wait()
+
+        return result
+
+    def get_status(self):
+
+        return {
+            "pid": os.getpid(),
+            "uptime": time.time() - self.started,
+            "requests": self.requests,
+            "cached": len(lazy_import("_app").warm_cache or {}),
+        }
+
+    def run(self, conn, message, fds):
+
+        app = lazy_import("_app")
+        ssh = lazy_import("_ssh")
+
+        self.requests += 1
+
+        # -----------------------------------------------
+        # Switch to the client's terminal and environment
+        # -----------------------------------------------
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        saved_fds = [os.dup(fd) for fd in (0, 1, 2)]
+        for fd, client_fd in zip((0, 1, 2), fds):
+            os.dup2(client_fd, fd)
+
+        saved_env = os.environ.copy()
+        saved_cwd = os.getcwd()
+        saved_iterfzf = app.iterfzf
+
+        # variables the client does not have are not inherited either
+        for key in client_env:
+            os.environ.pop(key, None)
+
+        os.environ.update(message.get("env", {}))
+        os.chdir(message.get("cwd", "/"))
+
+        app.iterfzf = lambda choices, **kwargs: self.select(conn, choices, kwargs)
+
+        # -----------------------------------------------
+        # Run the request
+        # -----------------------------------------------
+        reply = {"exit": 0}
+
+        try:
+            self.running = True
+            reply["attach"] = self.handler(message["argv"])
+        except KeyboardInterrupt:
+            reply["exit"] = 130
+        except ssh.TerminalRequired:
+            # prompts need the client's controlling terminal
+            reply = {"local": True}
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+                reply["exit"] = 1
+            else:
+                reply["exit"] = e.code or 0
+        except Exception:
+            traceback.print_exc()
+            reply["exit"] = 1
+        finally:
+            self.running = False
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            for fd, saved_fd in zip((0, 1, 2), saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+
+            os.environ.clear()
+            os.environ.update(saved_env)
+            os.chdir(saved_cwd)
+
+            app.iterfzf = saved_iterfzf
+
+        return reply
+
+    def select(self, conn, choices, kwargs):
+
+        # let the client run fzf, choices are sent as they are produced
+        send(conn, {"select": kwargs})
+
+        for choice in choices:
+            send(conn, {"choice": choice})
+
+        send(conn, {"choices": "end"})
+
+        message = json.loads(conn.makefile("r").readline())
+
+        return message.get("selected")
+
+
+def start(handler, foreground=False):
+
+    if connect() is not None:
+        sys.exit("Ultimux daemon is already running!")
+
+    if not foreground:
+        os.makedirs(base_dir, mode=0o700, exist_ok=True)
+
+        print(f"Start ultimux daemon, log in {log_path}...")
+
+        # detach from the terminal
+        if os.fork():
+            return
+
+        os.setsid()
+
+        if os.fork():
+            os._exit(0)
+
+        log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        null = os.open(os.devnull, os.O_RDONLY)
+
+        os.dup2(null, 0)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+
+    # keep output in order with the output of tmux and ssh
+    sys.stdout.reconfigure(line_buffering=True)
+
+    Daemon(handler).serve()
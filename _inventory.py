@@ -0,0 +1,201 @@
+#! /usr/bin/env python3
+
+import json, os, sys
+
+import globre
+
+from _timings import lazy_import
+
+# compiled glob patterns, shared by all inventories
+matchers = {}
+
+
+def glob_match(pattern, value):
+
+    if pattern not in matchers:
+        matchers[pattern] = globre.compile(pattern, flags=globre.EXACT)
+
+    return matchers[pattern].match(value) is not None
+
+
+class Inventory:
+
+    # -----------------------------------------------
+    # Host inventory index
+    # -----------------------------------------------
+    # built once per loaded config: host -> record and group -> hosts,
+    # every host is member of <all>, hosts without groups of <none>,
+    # hosts and group members are kept in natural sort order, hosts not
+    # matching group_match/host_match are dropped while loading
+
+    def __init__(
+        self,
+        host_configs,
+        is_valid_host=None,
+        dir_configs=[],
+        group_match=None,
+        host_match=None,
+    ):
+
+        self.hosts = {}
+        self.groups = {}
+
+        # host -> position in natural sort order
+        self.ranks = {}
+
+        # (pattern, group) -> bool
+        self.group_matches = {}
+
+        self.is_valid_host = is_valid_host
+
+        self.dir_configs = dir_configs
+        self.group_match = group_match
+        self.host_match = host_match
+
+        for host_config in host_configs:
+            self.add_host(host_config)
+
+        self.sort()
+
+    def add_host(self, host_config):
+
+        host = host_config["host"]
+
+        # first record wins
+        if host in self.hosts:
+            return
+
+        # validate once at load time
+        if self.is_valid_host and (not self.is_valid_host(host) or host[-1] == "."):
+            print(f"Skip illegal host: '{host}'")
+            return
+
+        if self.host_match and not glob_match(self.host_match, host):
+            return
+
+        if "groups" not in host_config:
+            groups = ["<none>", "<all>"]
+        else:
+            groups = list(host_config["groups"])
+            if "<all>" not in groups:
+                groups.append("<all>")
+
+        if self.group_match and not any(
+            self.match_group(self.group_match, g) for g in groups
+        ):
+            return
+
+        record = host_config.copy()
+        record["groups"] = groups
+
+        self.hosts[host] = record
+
+        for group in record["groups"]:
+            self.groups.setdefault(group, []).append(host)
+
+    def sort(self):
+
+        order = lazy_import("natsort").natsorted(self.hosts)
+
+        self.ranks = {host: rank for rank, host in enumerate(order)}
+        self.hosts = {host: self.hosts[host] for host in order}
+
+        for hosts in self.groups.values():
+            hosts.sort(key=self.get_rank)
+
+    def get_rank(self, host):
+
+        return self.ranks[host]
+
+    def get_host(self, host):
+
+        return self.hosts.get(host)
+
+    def match_group(self, pattern, group):
+
+        key = (pattern, group)
+
+        if key not in self.group_matches:
+            self.group_matches[key] = glob_match(pattern, group)
+
+        return self.group_matches[key]
+
+    def select(self, group_match=None, host_match=None):
+
+        # group -> {host: record}, only groups with matching hosts
+        if host_match:
+            hosts_matched = set(h for h in self.hosts if glob_match(host_match, h))
+
+        groups = {}
+
+        for group, hosts in self.groups.items():
+
+            if group_match and not self.match_group(group_match, group):
+                continue
+
+            if host_match:
+                hosts = [h for h in hosts if h in hosts_matched]
+
+            if hosts:
+                groups[group] = {h: self.hosts[h] for h in hosts}
+
+        return groups
+
+    def get_dirs(self, host):
+
+        dirs = []
+
+        for dir_config in self.dir_configs:
+
+            for pattern in dir_config["group_match"]:
+
+                for group in self.hosts[host]["groups"]:
+
+                    if self.match_group(pattern, group):
+                        dirs.extend(dir_config["paths"])
+
+        return dirs
+
+
+# -----------------------------------------------
+# JSON Lines inventory
+# -----------------------------------------------
+# one json object per line: host records ({"host": ...}) and dir records
+# ({"group_match": [...], "paths": [...]}), empty and # lines are skipped
+
+
+def read_jsonl(file_path, dir_configs):
+
+    # stream host records, collect dir records into dir_configs
+    with open(file_path) as file:
+
+        for number, line in enumerate(file, 1):
+
+            line = line.strip()
+
+            if not line or line.startswith("#"):
+                continue
+
+            try:
+                entry = json.loads(line)
+            except ValueError as e:
+                print(e)
+                sys.exit(f"Exception in parsing jsonl file {file_path} line {number}!")
+
+            if "host" in entry:
+                yield entry
+            elif "paths" in entry:
+                dir_configs.append(entry)
+            else:
+                sys.exit(f"Illegal record in {file_path} line {number}!")
+
+
+def write_jsonl(file_path, host_configs, dir_configs):
+
+    # replace atomically, the file may be read by running sessions
+    with open(f"{file_path}.{os.getpid()}", "w") as file:
+
+        for entry in list(host_configs) + list(dir_configs):
+            file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    os.replace(f"{file_path}.{os.getpid()}", file_path)
@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+
+# -----------------------------------------------
+# Precomputed window layouts
+# -----------------------------------------------
+# a layout is a tree of cells like tmux keeps it: leaves are panes,
+# containers split their area left-right ("{") or top-bottom ("["),
+# neighbouring cells are separated by a one cell border
+
+
+class Cell:
+    def __init__(self, kind=None, children=[]):
+
+        self.kind = kind
+        self.children = list(children)
+
+        self.sx = self.sy = self.x = self.y = 0
+
+    def is_leaf(self):
+
+        return self.kind is None
+
+    def count(self):
+
+        if self.is_leaf():
+            return 1
+
+        return sum(child.count() for child in self.children)
+
+
+def get_kind(split):
+
+    return "{" if split == "-h" else "["
+
+
+def chain(splits):
+
+    # panes created one by one by splitting the previous pane, splits[0]
+    # is ignored, splits[i] is -h or -v for pane i
+    cell = Cell()
+
+    for split in reversed(splits[1:]):
+
+        kind = get_kind(split)
+
+        # splitting along the container direction adds a sibling
+        if cell.kind == kind:
+            cell = Cell(kind, [Cell()] + cell.children)
+        else:
+            cell = Cell(kind, [Cell(), cell])
+
+    return cell
+
+
+def rows(splits):
+
+    # -f starts a new row spanning the window width
+    row_splits = []
+
+    for index, split in enumerate(splits):
+        if index == 0 or split == "-f":
+            row_splits.append([None])
+        else:
+            row_splits[-1].append(split)
+
+    cells = [chain(s) for s in row_splits]
+
+    return cells[0] if len(cells) == 1 else Cell("[", cells)
+
+
+def tiled(panes):
+
+    # same grid as the tmux tiled layout, the last row may be shorter
+    height = width = 1
+
+    while height * width < panes:
+        height += 1
+        if height * width < panes:
+            width += 1
+
+    cells = []
+
+    for row in range(height):
+
+        count = min(width, panes - row * width)
+
+        if count <= 0:
+            break
+
+        if count == 1:
+            cells.append(Cell())
+        else:
+            cells.append(Cell("{", [Cell() for _ in range(count)]))
+
+    return cells[0] if len(cells) == 1 else Cell("[", cells)
+
+
+def resize(cell, sx, sy, x=0, y=0):
+
+    # spread the area evenly, False if a pane ends up without space
+    cell.sx, cell.sy, cell.x, cell.y = sx, sy, x, y
+
+    if cell.is_leaf():
+        return sx >= 1 and sy >= 1
+
+    count = len(cell.children)
+    total = sx if cell.kind == "{" else sy
+
+    size, extra = divmod(total - (count - 1), count)
+
+    if size < 1:
+        return False
+
+    fits = True
+
+    for index, child in enumerate(cell.children):
+
+        # the last cells take the remainder
+        child_size = size + (1 if index >= count - extra else 0)
+
+        if cell.kind == "{":
+            fits = resize(child, child_size, sy, x, y) and fits
+            x += child_size + 1
+        else:
+            fits = resize(child, sx, child_size, x, y) and fits
+            y += child_size + 1
+
+    return fits
+
+
+def split_ops(cell, index=0, ops=None):
+
+    # (pane index to split, -h/-v, new pane size) creating the layout
+    # without resizing other panes: the new pane always takes the rest,
+    # children are split from the last to keep earlier indexes stable
+    if ops is None:
+        ops = []
+
+    if cell.is_leaf():
+        return ops
+
+    flag = "-h" if cell.kind == "{" else "-v"
+    rest = cell.sx if cell.kind == "{" else cell.sy
+
+    for offset, child in enumerate(cell.children[:-1]):
+        rest -= (child.sx if cell.kind == "{" else child.sy) + 1
+        ops.append((index + offset, flag, rest))
+
+    for offset in range(len(cell.children) - 1, -1, -1):
+        split_ops(cell.children[offset], index + offset, ops)
+
+    return ops
+
+
+def render(cell, ids=None):
+
+    if ids is None:
+        ids = iter(range(cell.count()))
+
+    dump = "{}x{},{},{}".format(cell.sx, cell.sy, cell.x, cell.y)
+
+    if cell.is_leaf():
+        return "{},{}".format(dump, next(ids))
+
+    close = "}" if cell.kind == "{" else "]"
+
+    return dump + cell.kind + ",".join(render(c, ids) for c in cell.children) + close
+
+
+def checksum(layout):
+
+    # layout_checksum of tmux
+    csum = 0
+
+    for char in layout:
+        csum = (csum >> 1) + ((csum & 1) << 15)
+        csum = (csum + ord(char)) & 0xFFFF
+
+    return csum
+
+
+def layout_string(cell):
+
+    layout = render(cell)
+
+    return "{:04x},{}".format(checksum(layout), layout)
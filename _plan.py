@@ -0,0 +1,79 @@
+#! /usr/bin/env python3
+
+import shlex
+
+
+class TmuxOp:
+
+    # -----------------------------------------------
+    # One tmux command of a launch plan
+    # -----------------------------------------------
+    # kind is the tmux command (new-session, new-window, split-window,
+    # send-keys, set-option, select-layout, select-pane, attach), target
+    # the session/window/pane it acts on, window and pane the indexes of
+    # the session config entry it was compiled from
+
+    def __init__(self, kind, target=None, args=[], window=None, pane=None):
+
+        self.kind = kind
+        self.target = target
+        # tmux commands take strings only (yaml may give numbers)
+        self.args = [str(arg) for arg in args]
+        self.window = window
+        self.pane = pane
+
+    def argv(self):
+
+        argv = [self.kind]
+
+        if self.target is not None:
+            # new-session names the session it creates
+            argv += ["-s" if self.kind == "new-session" else "-t", self.target]
+
+        return argv + self.args
+
+    def to_dict(self):
+
+        return {
+            "kind": self.kind,
+            "target": self.target,
+            "args": self.args,
+            "window": self.window,
+            "pane": self.pane,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+
+        return cls(
+            data["kind"],
+            data.get("target"),
+            data.get("args", []),
+            data.get("window"),
+            data.get("pane"),
+        )
+
+
+# -----------------------------------------------
+# Renderers
+# -----------------------------------------------
+def render_command(op):
+
+    # tmux command syntax, used by shell strings and control mode
+    return " ".join(shlex.quote(arg) for arg in op.argv())
+
+
+def render_shell(plan):
+
+    return ["tmux " + render_command(op) for op in plan]
+
+
+def render_script(plan, marker="utmx-ok"):
+
+    # source-file script with one command per line, a failing command
+    # only skips its own line, the marker printed after each command
+    # tells which ones ran
+    return "".join(
+        "{} ; display-message -p '{} {}'\n".format(render_command(op), marker, index)
+        for index, op in enumerate(plan)
+    )
@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+
+import glob, os, re
+
+from _cache import JsonCache, file_signature
+from _timings import lazy_import, span
+
+# a top level mapping key starts a session block
+session_key = re.compile(
+    rb"^(?![#\-\.\s])('[^'\n]*'|\"[^\"\n]*\"|[^:#\n]+?):(?:\s|$)", re.M
+)
+
+
+def scan_sessions(file_path):
+
+    # session name -> [start, end] byte offsets of its block
+    with open(file_path, "rb") as file:
+        data = file.read()
+
+    sessions = {}
+    previous = None
+
+    for match in session_key.finditer(data):
+
+        name = match.group(1).decode(errors="replace").strip()
+
+        if name[:1] in ("'", '"'):
+            name = name[1:-1]
+
+        if previous is not None:
+            sessions[previous][1] = match.start()
+
+        sessions[name] = [match.start(), len(data)]
+        previous = name
+
+    return sessions
+
+
+class SessionIndex:
+
+    # -----------------------------------------------
+    # Session name -> config file index
+    # -----------------------------------------------
+    # stored in the cache dir as {file: {"signature": [...], "sessions":
+    # {name: [start, end]}}}, only files with a changed signature are
+    # scanned again, removed files are dropped
+
+    def __init__(self, config_dirs, pattern="*.run.yml"):
+
+        self.config_dirs = config_dirs
+        self.pattern = pattern
+        self.cache = JsonCache("sessions")
+        self.files = {}
+
+    def refresh(self):
+
+        file_paths = []
+        for config_dir in self.config_dirs:
+            file_paths += glob.glob(os.path.join(config_dir, self.pattern))
+
+        file_paths.sort()
+
+        with span("session index", files=len(file_paths)):
+
+            cached = self.cache.load()
+            changed = set(cached) != set(file_paths)
+
+            self.files = {}
+
+            for file_path in file_paths:
+
+                try:
+                    signature = file_signature(file_path)
+                except OSError:
+                    changed = True
+                    continue
+
+                entry = cached.get(file_path)
+
+                if not isinstance(entry, dict) or entry.get("signature") != signature:
+                    entry = {
+                        "signature": signature,
+                        "sessions": scan_sessions(file_path),
+                    }
+                    changed = True
+
+                self.files[file_path] = entry
+
+            if changed:
+                try:
+                    with self.cache.lock():
+                        self.cache.save(self.files)
+                except OSError:
+                    pass
+
+    def sessions(self):
+
+        # (session name, file) in file order
+        return [(s, f) for f, entry in self.files.items() for s in entry["sessions"]]
+
+    def find(self, session_name):
+
+        return [
+            f for f, entry in self.files.items() if session_name in entry["sessions"]
+        ]
+
+    def load(self, file_path, session_name):
+
+        # parse the session block only, None if it does not stand alone
+        start, end = self.files[file_path]["sessions"][session_name]
+
+        with open(file_path, "rb") as file:
+            file.seek(start)
+            data = file.read(end - start)
+
+        yaml = lazy_import("yaml")
+
+        # use libyaml when available
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+        try:
+            with span("yaml parse session", file=file_path, session=session_name):
+                config = yaml.load(data, Loader=loader)
+        except yaml.YAMLError:
+            return None
+
+        if not isinstance(config, dict) or session_name not in config:
+            return None
+
+        return config[session_name]
@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+
+import contextlib, os, re, shlex, signal, socket, stat, subprocess, sys, time
+
+from _timings import lazy_import, span
+
+# control sockets of multiplexed connections, %C is a hash of the
+# destination which keeps the socket path short
+control_dir = "~/.ultimux/ssh"
+
+control_path = control_dir + "/%C"
+
+# batch mode errors of hosts that want a password or one time code
+auth_errors = re.compile(r"Permission denied|keyboard-interactive")
+
+# seconds to answer the prompts of an interactive probe
+prompt_timeout = 120
+
+# process groups of running remote commands, killed when a run is
+# interrupted
+running_groups = set()
+
+
+class TerminalRequired(Exception):
+
+    # ssh prompts on the controlling terminal, which the daemon lacks
+    pass
+
+
+def can_prompt():
+
+    # stdin has to be the controlling terminal ssh prompts on
+    try:
+        os.tcgetpgrp(0)
+    except OSError:
+        return False
+
+    return True
+
+
+def multiplex_options(persist="60s"):
+
+    return [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        "ControlPath={}".format(control_path),
+        "-o",
+        "ControlPersist={}".format(persist),
+    ]
+
+
+def cleanup_control_sockets():
+
+    # -----------------------------------------------
+    # Remove sockets without a master listening
+    # -----------------------------------------------
+    path = os.path.expanduser(control_dir)
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    for entry in os.scandir(path):
+
+        try:
+            if not stat.S_ISSOCK(entry.stat(follow_symlinks=False).st_mode):
+                continue
+
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(entry.path)
+        except ConnectionRefusedError:
+            # another process may have removed it already
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(entry.path)
+        except OSError:
+            # vanished or not accessible, leave it to ssh
+            continue
+
+
+def probe_destination(destination, timeout=10, options=[], batch=True):
+
+    # "ok", "auth" when batch mode could not authenticate or "fail", the
+    # interactive probe asks for passwords and codes on the terminal
+    command = [
+        "ssh",
+        *options,
+        "-o",
+        "BatchMode={}".format("yes" if batch else "no"),
+        "-o",
+        "ConnectTimeout={}".format(timeout),
+        destination,
+        "echo ok",
+    ]
+
+    start = time.monotonic()
+
+    with span("ssh probe", destination=destination, batch=batch):
+        try:
+            result = subprocess.run(
+                command,
+                stdin=subprocess.DEVNULL if batch else None,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE if batch else None,
+                text=True,
+                timeout=timeout * 2 if batch else prompt_timeout,
+            )
+
+            if result.returncode == 0:
+                status = "ok"
+            elif batch and auth_errors.search(result.stderr):
+                status = "auth"
+            else:
+                status = "fail"
+        except subprocess.TimeoutExpired:
+            status = "fail"
+
+    return status, time.monotonic() - start
+
+
+def map_destinations(func, destinations, workers=16, *args):
+
+    # -----------------------------------------------
+    # Run func(destination, *args) concurrently
+    # -----------------------------------------------
+    results = {}
+
+    if not destinations:
+        return results
+
+    workers = max(1, min(workers, len(destinations)))
+
+    futures_module = lazy_import("concurrent.futures")
+
+    executor = futures_module.ThreadPoolExecutor(max_workers=workers)
+
+    try:
+        futures = {}
+        for destination in destinations:
+            futures[destination] = executor.submit(func, destination, *args)
+
+        for destination in destinations:
+            results[destination] = futures[destination].result()
+    except BaseException:
+        # Ctrl-C: drop queued destinations and stop running commands
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        for pgid in list(running_groups):
+            with contextlib.suppress(OSError):
+                os.killpg(pgid, signal.SIGKILL)
+
+        raise
+
+    executor.shutdown()
+
+    return results
+
+
+def check_destinations(destinations, timeout=10, workers=16, options=[]):
+
+    results = map_destinations(
+        probe_destination, destinations, workers, timeout, options
+    )
+
+    # -----------------------------------------------
+    # Probe password and OTP hosts interactively
+    # -----------------------------------------------
+    # only hosts refusing batch authentication, one at a time on the
+    # terminal, unreachable hosts are not probed again
+    auth = [d for d, (status, _) in results.items() if status == "auth"]
+
+    if auth and sys.stdin.isatty():
+        if not can_prompt():
+            raise TerminalRequired(", ".join(auth))
+
+        for destination in auth:
+            print("Check {} interactively...".format(destination))
+            results[destination] = probe_destination(
+                destination, timeout, options, batch=False
+            )
+
+    return {d: (status == "ok", duration) for d, (status, duration) in results.items()}
+
+
+def list_remote_dirs(destination, roots, depth=1, timeout=10, options=[]):
+
+    # directories below roots (including roots), None if ssh failed
+    find = "find {} -maxdepth {} -type d 2>/dev/null".format(
+        " ".join(shlex.quote(root) for root in roots), int(depth)
+    )
+
+    command = [
+        "ssh",
+        *options,
+        "-o",
+        "BatchMode=yes",
+        "-o",
+        "ConnectTimeout={}".format(timeout),
+        destination,
+        find,
+    ]
+
+    with span("ssh discover", destination=destination):
+        try:
+            result = subprocess.run(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                timeout=timeout * 2,
+            )
+        except subprocess.TimeoutExpired:
+            return None
+
+    # 255 is reserved for ssh errors, find fails for missing roots
+    if result.returncode == 255:
+        return None
+
+    return sorted(line for line in result.stdout.splitlines() if line.startswith("/"))
+
+
+def discover_dirs(destinations, roots, depth=1, timeout=10, workers=16, options=[]):
+
+    return map_destinations(
+        list_remote_dirs, destinations, workers, roots, depth, timeout, options
+    )
+
+
+def run_destination(destination, command, timeout=60, options=[], on_line=None):
+
+    # run command on destination, on_line(destination, line) is called for
+    # every output line, returns (exit code or None on timeout, seconds)
+    argv = [
+        "ssh",
+        *options,
+        "-T",
+        "-o",
+        "BatchMode=yes",
+        "-o",
+        "ConnectTimeout={}".format(min(timeout, 10)),
+        destination,
+        command,
+    ]
+
+    start = time.monotonic()
+
+    with span("ssh run", destination=destination):
+        process = subprocess.Popen(
+            argv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            start_new_session=True,
+        )
+
+        running_groups.add(process.pid)
+
+        # kill the whole process group, children may hold the output open
+        def kill():
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        timer = lazy_import("threading").Timer(timeout, kill)
+        timer.start()
+
+        try:
+            for line in process.stdout:
+                if on_line:
+                    on_line(destination, line.rstrip("\n"))
+
+            returncode = process.wait()
+        finally:
+            timed_out = not timer.is_alive()
+            timer.cancel()
+            running_groups.discard(process.pid)
+
+    return None if timed_out else returncode, time.monotonic() - start
+
+
+def run_destinations(
+    destinations, command, timeout=60, workers=32, options=[], on_line=None
+):
+
+    return map_destinations(
+        run_destination, destinations, workers, command, timeout, options, on_line
+    )
@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+
+import _thread, contextlib, importlib, os, sys, time
+
+# reference point for all timings, set when the cli starts importing
+started = time.perf_counter()
+
+# spans are only measured when enabled
+enabled = False
+
+# (name, seconds)
+records = []
+
+# chrome trace events
+events = []
+
+disabled_span = contextlib.nullcontext()
+
+# python startup is only part of the first request of a process
+measure_startup = True
+
+
+class Span:
+    def __init__(self, name, args):
+
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        end = time.perf_counter()
+
+        record(self.name, end - self.start)
+
+        events.append(
+            {
+                "name": self.name,
+                "ph": "X",
+                "ts": (self.start - started) * 1e6,
+                "dur": (end - self.start) * 1e6,
+                "pid": os.getpid(),
+                "tid": _thread.get_ident(),
+                "args": self.args,
+            }
+        )
+
+
+def enable():
+
+    global enabled
+    enabled = True
+
+
+def reset():
+
+    # start over for a new request of a long running process
+    global started, enabled, measure_startup
+    started = time.perf_counter()
+    enabled = False
+    measure_startup = False
+
+    records.clear()
+    events.clear()
+
+
+def span(name, **args):
+
+    # measure a phase, free when timings are disabled
+    if not enabled:
+        return disabled_span
+
+    return Span(name, args)
+
+
+def record(name, seconds):
+
+    records.append((name, seconds))
+
+
+def lazy_import(name):
+
+    # import a module on first use and account for its import time
+    if name in sys.modules:
+        return sys.modules[name]
+
+    with Span(f"import {name}", {}):
+        module = importlib.import_module(name)
+
+    return module
+
+
+def get_interpreter_startup():
+
+    # time between process start and this module being imported (linux)
+    try:
+        with open("/proc/self/stat") as file:
+            start_ticks = int(file.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as file:
+            uptime = float(file.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    age = uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+    return max(0.0, age - (time.perf_counter() - started))
+
+
+def report():
+
+    # aggregate by name, in order of first occurrence
+    totals = {}
+    for name, seconds in records:
+        count, total, longest = totals.get(name, (0, 0.0, 0.0))
+        totals[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    print()
+    print("Timings".ljust(50), "count".rjust(6), "seconds".rjust(10), "max".rjust(10))
+
+    interpreter = get_interpreter_startup() if measure_startup else None
+    if interpreter is not None:
+        print(
+            "python startup".ljust(50, "."),
+            "1".rjust(6),
+            "{:10.3f}".format(interpreter),
+        )
+
+    for name, (count, total, longest) in totals.items():
+        print(
+            name.ljust(50, "."),
+            str(count).rjust(6),
+            "{:10.3f}".format(total),
+            "{:10.3f}".format(longest),
+        )
+
+    total = time.perf_counter() - started
+    print(
+        "total since cli start".ljust(50, "."), "1".rjust(6), "{:10.3f}".format(total)
+    )
+
+
+def write_trace(file_path):
+
+    # chrome trace event format, open in chrome://tracing or perfetto
+    json = lazy_import("json")
+
+    with open(file_path, "w") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
@@ -0,0 +1,111 @@
+#! /usr/bin/env python3
+
+import subprocess
+
+
+class TmuxReply:
+    def __init__(self, command, ok, output):
+
+        self.command = command
+        self.ok = ok
+        self.output = output
+
+
+class TmuxControl:
+
+    # -----------------------------------------------
+    # Persistent tmux control mode (-C) connection
+    # -----------------------------------------------
+    # the client is started with an initial command, e.g. new-session or
+    # attach-session, and stays attached until close() is called
+
+    def __init__(self, args):
+
+        self.process = subprocess.Popen(
+            ["tmux", "-C"] + args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+
+        self.pending = []
+
+        # the initial command is answered like any other command
+        self.pending.append(" ".join(args))
+        self.initial = self.read_reply()
+
+        if self.initial.ok:
+            # do not stream pane output to this client (tmux >= 3.2)
+            self.command("refresh-client -f no-output")
+
+    def send(self, command):
+
+        if self.process.poll() is not None:
+            return False
+
+        self.process.stdin.write(command + "\n")
+        self.process.stdin.flush()
+        self.pending.append(command)
+
+        return True
+
+    def read_reply(self):
+
+        command = self.pending.pop(0)
+
+        begin = None
+        output = []
+
+        for line in self.process.stdout:
+            line = line.rstrip("\n")
+
+            if begin is None:
+                # notifications outside of a reply block
+                if line.startswith("%begin "):
+                    begin = line.split(" ")[1:3]
+                elif line.startswith("%exit"):
+                    break
+
+                continue
+
+            for guard in ["%end ", "%error "]:
+                if line.startswith(guard) and line.split(" ")[1:3] == begin:
+                    return TmuxReply(command, guard == "%end ", output)
+
+            output.append(line)
+
+        return TmuxReply(command, False, output + ["tmux control client exited"])
+
+    def command(self, command):
+
+        if not self.send(command):
+            return TmuxReply(command, False, ["tmux control client exited"])
+
+        return self.read_reply()
+
+    def commands(self, commands):
+
+        return list(self.iter_replies(commands))
+
+    def iter_replies(self, commands):
+
+        # pipeline all commands, then yield the replies in order as they
+        # arrive
+        sent = 0
+        for command in commands:
+            if not self.send(command):
+                break
+            sent += 1
+
+        for _ in range(sent):
+            yield self.read_reply()
+
+        for command in commands[sent:]:
+            yield TmuxReply(command, False, ["tmux control client exited"])
+
+    def close(self):
+
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
@@ -1,6 +1,20 @@
 #! /usr/bin/env python3
 
-import ast, datetime, os, re, subprocess, sys
+import datetime, json, re, subprocess, sys
+
+import _layout
+
+from _cache import JsonCache
+from _plan import TmuxOp, render_command, render_script, render_shell
+from _ssh import check_destinations, cleanup_control_sockets, multiplex_options
+from _timings import lazy_import, span
+from _tmux import TmuxControl, TmuxReply
+
+# plan commands that create a pane
+new_pane_kinds = ["new-session", "new-window", "split-window"]
+
+# pane option holding the ssh destination of a pane
+host_option = "@utmx_host"
 
 
 class Ultimux:
@@ -8,7 +22,7 @@ class Ultimux:
     # -----------------------------------------------
     # Application properties
     # -----------------------------------------------
-    tmux_commands = []
+    plan = []
 
     session_config = {}
 
@@ -22,12 +36,35 @@ class Ultimux:
     # Dynamic properties
     # -----------------------------------------------
 
+    attach = True
+
     col = False
 
     debug = False
 
+    executor = "batch"
+
+    check_cache_ttl = 300
+
+    check_timeout = 10
+
+    check_workers = 16
+
+    # one send-keys per pane: True, False or "auto" (coalesce_panes or more)
+    coalesce = "auto"
+
+    coalesce_panes = 10
+
     focus = "0.0"
 
+    multiplex = False
+
+    multiplex_persist = "60s"
+
+    recheck = False
+
+    reconcile = False
+
     sync = False
 
     validated_destinations = []
@@ -39,10 +76,21 @@ class Ultimux:
         # -----------------------------------------------
         # Check if tmux is installed
         # -----------------------------------------------
+        # (major, minor) or None for unknown (development) versions
+        self.tmux_version = None
+
         try:
-            subprocess.call(
-                ["tmux", "-V"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-            )
+            version = subprocess.run(
+                ["tmux", "-V"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+            ).stdout
+
+            match = re.search(r"(\d+)\.(\d+)", version)
+
+            if match:
+                self.tmux_version = (int(match.group(1)), int(match.group(2)))
         except OSError:
             print("Tmux is not installed...")
 
@@ -66,7 +114,9 @@ class Ultimux:
         # -----------------------------------------------
         # Set defaults
         # -----------------------------------------------
-        self.tmux_commands = []
+        self.plan = []
+
+        self.live = {}
 
         self.focus = "0.0"
 
@@ -82,10 +132,61 @@ class Ultimux:
         # columns
         self.tiled = False
 
-    def fail(self, message=""):
+    @property
+    def tmux_commands(self):
+
+        return render_shell(self.plan)
+
+    def add_op(self, kind, target=None, args=[], window=None, pane=None):
+
+        op = TmuxOp(kind, target, args, window, pane)
+        self.plan.append(op)
+
+        return op
+
+    @staticmethod
+    def fail(message=""):
         print(message)
         sys.exit(1)
 
+    def set_attach(self, attach):
+
+        if not type(attach) == bool:
+            self.fail("Directive attach must be boolean!")
+
+        self.attach = attach
+
+    def set_check_cache_ttl(self, check_cache_ttl):
+
+        if not type(check_cache_ttl) == int or check_cache_ttl < 0:
+            self.fail("Check cache ttl must be a number of seconds!")
+
+        self.check_cache_ttl = check_cache_ttl
+
+    def set_check_timeout(self, check_timeout):
+
+        if not type(check_timeout) == int or check_timeout < 1:
+            self.fail("Check timeout must be a positive number!")
+
+        self.check_timeout = check_timeout
+
+    def set_check_workers(self, check_workers):
+
+        if not type(check_workers) == int or check_workers < 1:
+            self.fail("Check workers must be a positive number!")
+
+        self.check_workers = check_workers
+
+    def set_coalesce(self, coalesce):
+
+        if coalesce in ["on", "off"]:
+            coalesce = coalesce == "on"
+
+        if not (type(coalesce) == bool or coalesce == "auto"):
+            self.fail("Directive coalesce must be boolean or auto!")
+
+        self.coalesce = coalesce
+
     def set_debug(self, debug):
 
         if not type(debug) == bool:
@@ -93,6 +194,13 @@ class Ultimux:
 
         self.debug = debug
 
+    def set_executor(self, executor):
+
+        if not executor in ["batch", "control", "single"]:
+            self.fail("Executor must be batch, control or single!")
+
+        self.executor = executor
+
     def set_focus(self, focus):
 
         if not re.match(r"^[0-9]+\.[0-9]+$", focus):
@@ -114,6 +222,41 @@ class Ultimux:
 
         self.tiled = tiled
 
+    def set_multiplex(self, multiplex):
+
+        if not type(multiplex) == bool:
+            self.fail("Directive multiplex must be boolean!")
+
+        self.multiplex = multiplex
+
+    def set_multiplex_persist(self, multiplex_persist):
+
+        if not re.match(r"^(yes|no|[0-9]+[smhdw]?)$", str(multiplex_persist)):
+            self.fail("Multiplex persist must be yes, no or a time!")
+
+        self.multiplex_persist = str(multiplex_persist)
+
+    def get_ssh_command_options(self):
+
+        if not self.multiplex:
+            return []
+
+        return multiplex_options(self.multiplex_persist)
+
+    def set_reconcile(self, reconcile):
+
+        if not type(reconcile) == bool:
+            self.fail("Directive reconcile must be boolean!")
+
+        self.reconcile = reconcile
+
+    def set_recheck(self, recheck):
+
+        if not type(recheck) == bool:
+            self.fail("Directive recheck must be boolean!")
+
+        self.recheck = recheck
+
     def set_sync(self, sync):
 
         if not type(sync) == bool:
@@ -148,9 +291,23 @@ class Ultimux:
             session_config["windows"] = []
             session_config["windows"].append(window_config)
 
+        # ---------------------------------------
+        # Check ssh connectivity up front
+        # ---------------------------------------
+        if self.multiplex:
+            cleanup_control_sockets()
+
+        self.check_connectivity()
+
         # ---------------------------------------
         # Iterate windows
         # ---------------------------------------
+        # layouts are computed for the current terminal
+        window_size = self.get_window_size()
+
+        # windows of a running session keep their panes
+        self.live = self.get_live_panes() if self.reconcile else {}
+
         # window counter
         i = 0
 
@@ -161,31 +318,31 @@ class Ultimux:
             # ---------------------------------------
             if "name" in window.keys():
                 window_name = window["name"]
+            elif type(window.get("ssh")) == dict:
+                window_name = self.get_destination(window["ssh"])
             elif "ssh" in window.keys():
                 window_name = window["ssh"]
             else:
-                window_name = window["win{}".format(i)]
+                window_name = "win{}".format(i)
+
+            window_target = "{}:{}".format(self.session_name, i)
 
             # ---------------------------------------
             # Create tmux session/window
             # ---------------------------------------
             # first loop: create a session + window with -n option
             if i == 0:
-                self.tmux_commands.append(
-                    "tmux new-session -d -A -s {} -n '{}'".format(
-                        self.session_name, window_name
-                    )
+                self.add_op(
+                    "new-session",
+                    self.session_name,
+                    ["-d", "-A", "-n", window_name, "-x", str(window_size[0])]
+                    + ["-y", str(window_size[1])],
+                    window=i,
+                    pane=0,
                 )
             # first window is alreay set, skip
             else:
-                self.tmux_commands.append(
-                    "tmux new-window -t '{}' -n '{}' ".format(
-                        self.session_name, window_name
-                    )
-                )
-
-            # pane counter
-            ii = 0
+                self.add_op("new-window", self.session_name, ["-n", window_name], i, 0)
 
             # ---------------------------------------
             # Default to global pane
@@ -207,13 +364,11 @@ class Ultimux:
             # ---------------------------------------
             # Iterate panes
             # ---------------------------------------
-            for pane in panes:
+            # (split, command, pane config) in pane index order, a full
+            # split (-f) starts a new row
+            pane_specs = []
 
-                # full split for new pane (row)
-                if ii > 0:
-                    self.tmux_commands.append(
-                        "tmux split-window -f -t '{}'".format(self.session_name)
-                    )
+            for pane in panes:
 
                 if type(pane) == dict:
                     for config_type in ["dir", "shell"]:
@@ -239,8 +394,10 @@ class Ultimux:
 
                 shell_cmds = self.parse_shell(pane["shell"])
 
-                if pane["dir"] and pane["dir"] != [""]:
-                    cmds = [f"cd {pane['dir']}; {shell_cmds[0]}"]
+                directory = self.parse_shell(pane.get("dir"))[0]
+
+                if directory:
+                    cmds = [f"cd {directory}; {shell_cmds[0]}"]
                 else:
                     cmds = self.parse_shell(pane["shell"])
 
@@ -265,19 +422,35 @@ class Ultimux:
                     if not split in ["-v", "-h"]:
                         self.fail("Illegal split! Use -v or -h...")
 
-                    if iii > 0:
-                        self.tmux_commands.append(
-                            "tmux split-window {} -t '{}'".format(
-                                split, self.session_name
-                            )
-                        )
+                    # the first command of a pane entry is a new row
+                    if iii == 0:
+                        split = "-f"
 
-                    target = self.session_name + ":" + str(i) + "." + str(ii)
-
-                    self.parse_command(command, pane, window, target)
+                    pane_specs.append((split, command, pane))
 
                     iii += 1
-                    ii += 1
+
+            layout = ""
+
+            if "layout" in window.keys():
+                if window.get("layout"):
+                    layout = window.get("layout")
+            elif session_config.get("layout"):
+                layout = session_config.get("layout")
+
+            if self.tiled:
+                layout = "tiled"
+
+            # ---------------------------------------
+            # Create panes and apply the layout once
+            # ---------------------------------------
+            self.create_panes(
+                window_target, i, [spec[0] for spec in pane_specs], layout, window_size
+            )
+
+            # commands by final pane index
+            for ii, (split, command, pane) in enumerate(pane_specs):
+                self.parse_command(command, pane, window, i, ii)
 
             synchronize_panes = False
 
@@ -290,45 +463,372 @@ class Ultimux:
                 synchronize_panes = True
 
             if synchronize_panes:
-                self.tmux_commands.append(
-                    "tmux set-option -t '{}' synchronize-panes on".format(
-                        self.session_name
-                    )
+                self.add_op(
+                    "set-option", window_target, ["-w", "synchronize-panes", "on"], i
                 )
 
-            layout = ""
-
-            if "layout" in window.keys():
-                if window.get("layout"):
-                    layout = window.get("layout")
-            elif session_config.get("layout"):
-                layout = session_config.get("layout")
-
-            if self.tiled:
-                layout = "tiled"
-
-            # layout
-            if not layout == "":
-                self.tmux_commands.append("tmux select-layout {}".format(layout))
-
             i += 1  # window
 
         # ---------------------------------------
         # Set options and attach
         # ---------------------------------------
-        self.tmux_commands.append("tmux set-option -g status-style bg=blue")
+        self.add_op("set-option", None, ["-g", "status-style", "bg=blue"])
 
         # support 256 colors
-        self.tmux_commands.append("tmux set -g default-terminal 'screen-256color'")
+        self.add_op("set-option", None, ["-g", "default-terminal", "screen-256color"])
 
         # set focus
-        self.tmux_commands.append(
-            "tmux select-pane -t '{}:{}'".format(self.session_name, self.focus)
+        focus_target = "{}:{}".format(self.session_name, self.focus)
+
+        self.add_op("select-pane", focus_target)
+
+        if self.attach:
+            self.add_op("attach", focus_target)
+
+        self.coalesce_plan()
+
+        if self.reconcile:
+            self.reconcile_plan()
+
+    def get_window_size(self):
+
+        # terminal size without the status line
+        columns, lines = lazy_import("shutil").get_terminal_size()
+
+        return columns, max(1, lines - 1)
+
+    def create_panes(self, window_target, window_index, splits, layout, size):
+
+        # ---------------------------------------
+        # Compute the final geometry
+        # ---------------------------------------
+        # splits[ii] is how pane ii is split off (-f for a new row), named
+        # layouts other than tiled are still applied by tmux
+        if layout == "tiled":
+            cell = _layout.tiled(len(splits))
+        else:
+            cell = _layout.rows(splits)
+
+        fits = _layout.resize(cell, *size)
+
+        # ---------------------------------------
+        # Split panes
+        # ---------------------------------------
+        if fits and window_index not in self.live:
+            # every split gives the new pane its final size and leaves
+            # the other panes alone, so nothing is reflowed
+            for index, flag, pane_size in _layout.split_ops(cell):
+                self.add_op(
+                    "split-window",
+                    "{}.{}".format(window_target, index),
+                    [flag, "-l", str(pane_size)],
+                    window_index,
+                    index + 1,
+                )
+        else:
+            if not fits:
+                print("{} panes do not fit in {}x{}...".format(len(splits), *size))
+
+            # append to the last pane, which keeps existing pane indexes
+            for ii in range(1, len(splits)):
+                last_pane = "{}.{}".format(window_target, ii - 1)
+                self.add_op("split-window", last_pane, [splits[ii]], window_index, ii)
+
+        # ---------------------------------------
+        # Layout
+        # ---------------------------------------
+        if layout and layout != "tiled":
+            self.add_op("select-layout", window_target, [layout], window_index)
+        elif fits and len(splits) > 1:
+            self.add_op(
+                "select-layout",
+                window_target,
+                [_layout.layout_string(cell)],
+                window_index,
+            )
+        # tmux still tiles windows that do not fit the terminal
+        elif layout == "tiled":
+            self.add_op("select-layout", window_target, [layout], window_index)
+
+    def get_live_panes(self):
+
+        # window index -> (window name, pane indexes) of the running session
+        result = subprocess.run(
+            [
+                "tmux",
+                "list-panes",
+                "-s",
+                "-t",
+                self.session_name,
+                "-F",
+                "#{window_index}\t#{window_name}\t#{pane_index}",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
         )
-        self.tmux_commands.append(
-            "tmux attach -t '{}:{}'".format(self.session_name, self.focus)
+
+        live = {}
+
+        if result.returncode:
+            return live
+
+        for line in result.stdout.splitlines():
+            window_index, window_name, pane_index = line.split("\t")
+            window = live.setdefault(int(window_index), (window_name, set()))
+            window[1].add(int(pane_index))
+
+        return live
+
+    def reconcile_plan(self):
+
+        # ---------------------------------------
+        # Diff plan against the running session
+        # ---------------------------------------
+        live = self.live
+
+        if not live:
+            return
+
+        for op in self.plan:
+            if op.kind in ["new-session", "new-window"] and op.window in live:
+                live_name = live[op.window][0]
+                window_name = op.args[op.args.index("-n") + 1]
+
+                if live_name != window_name:
+                    self.fail(
+                        "Window {} is '{}', expected '{}'!".format(
+                            op.window, live_name, window_name
+                        )
+                    )
+
+        def exists(op):
+            return op.window in live and op.pane in live[op.window][1]
+
+        # windows that get new panes
+        changed = set(
+            op.window for op in self.plan if op.pane is not None and not exists(op)
         )
 
+        plan = []
+
+        for op in self.plan:
+
+            # existing windows and panes are left alone
+            if op.kind in [
+                "new-session",
+                "new-window",
+                "split-window",
+                "send-keys",
+                "set-option",
+            ]:
+                if exists(op):
+                    continue
+
+            # re-layout only windows with new panes
+            if op.kind == "select-layout" and op.window not in changed:
+                continue
+
+            plan.append(op)
+
+        print(
+            "Reconcile {}: {} of {} tmux commands required...".format(
+                self.session_name, len(plan), len(self.plan)
+            )
+        )
+
+        self.plan = plan
+
+    # ---------------------------------------
+    # Panes across sessions
+    # ---------------------------------------
+    @classmethod
+    def get_panes(cls):
+
+        # all panes of the tmux server in one query
+        result = subprocess.run(
+            [
+                "tmux",
+                "list-panes",
+                "-a",
+                "-F",
+                "\t".join(
+                    [
+                        "#{session_name}",
+                        "#{window_index}",
+                        "#{window_name}",
+                        "#{pane_index}",
+                        "#{" + host_option + "}",
+                    ]
+                ),
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+
+        panes = []
+
+        if result.returncode:
+            return panes
+
+        for line in result.stdout.splitlines():
+            session, window, window_name, pane, host = line.split("\t")
+            panes.append(
+                {
+                    "target": "{}:{}.{}".format(session, window, pane),
+                    "session": session,
+                    "window": window,
+                    "window_name": window_name,
+                    "pane": pane,
+                    "host": host,
+                }
+            )
+
+        return panes
+
+    @classmethod
+    def match_panes(cls, panes, target_match=[], host_match=None, hosts=None):
+
+        glob_match = lazy_import("_inventory").glob_match
+
+        def match_target(pane):
+            names = [
+                pane["target"],
+                "{}:{}.{}".format(pane["session"], pane["window_name"], pane["pane"]),
+            ]
+            return any(glob_match(p, n) for p in target_match for n in names)
+
+        def match_host(pane):
+            # destinations are user@host
+            names = [pane["host"], pane["host"].rsplit("@", 1)[-1]]
+            if host_match and not any(glob_match(host_match, n) for n in names):
+                return False
+            return hosts is None or names[1] in hosts
+
+        matched = []
+
+        for pane in panes:
+
+            if target_match and not match_target(pane):
+                continue
+
+            if (host_match or hosts is not None) and not match_host(pane):
+                continue
+
+            matched.append(pane)
+
+        return matched
+
+    @classmethod
+    def broadcast(cls, panes, command, enter=True):
+
+        # one send-keys per pane, run in a single batch
+        keys = [command, "C-m"] if enter else [command]
+
+        return [TmuxOp("send-keys", pane["target"], keys) for pane in panes]
+
+    @classmethod
+    def capture_panes(cls, panes, lines=None):
+
+        # (pane, reply) in pane order as the replies arrive, all captures
+        # are pipelined over one control mode connection
+        if not panes:
+            return
+
+        args = ["-p", "-J"]
+
+        if lines:
+            args += ["-S", str(-lines)]
+
+        commands = [
+            render_command(TmuxOp("capture-pane", pane["target"], args))
+            for pane in panes
+        ]
+
+        with span("tmux capture", panes=len(panes)):
+            control = TmuxControl(["attach-session", "-t", panes[0]["session"]])
+
+            if not control.initial.ok:
+                cls.fail("Could not attach to {}!".format(panes[0]["session"]))
+
+            try:
+                yield from zip(panes, control.iter_replies(commands))
+            finally:
+                control.close()
+
+    @classmethod
+    def strip_prompt(cls, lines, prompt):
+
+        # output of the last command: lines after the last prompt with a
+        # command, without the trailing prompt and blank lines
+        prompt = re.compile(prompt)
+
+        lines = [line.rstrip() for line in lines]
+
+        while lines and not lines[-1]:
+            lines.pop()
+
+        if lines and prompt.match(lines[-1]) and not prompt.sub("", lines[-1], 1):
+            lines.pop()
+
+        for i in range(len(lines) - 1, -1, -1):
+            if prompt.match(lines[i]) and prompt.sub("", lines[i], 1).strip():
+                lines = lines[i + 1 :]
+                break
+
+        while lines and not lines[0]:
+            lines.pop(0)
+
+        while lines and not lines[-1]:
+            lines.pop()
+
+        return lines
+
+    def coalesce_plan(self):
+
+        # ---------------------------------------
+        # Merge send-keys per pane
+        # ---------------------------------------
+        # "cmd1" C-m "cmd2" C-m ... becomes one literal send-keys with a
+        # carriage return (enter) after each command
+        if self.debug:
+            return
+
+        panes = len([op for op in self.plan if op.kind in new_pane_kinds])
+
+        if self.coalesce == "auto":
+            if panes < self.coalesce_panes:
+                return
+        elif not self.coalesce:
+            return
+
+        plan = []
+
+        for op in self.plan:
+
+            if op.kind != "send-keys" or op.args[-1:] != ["C-m"]:
+                plan.append(op)
+                continue
+
+            text = " ".join(op.args[:-1]) + "\r"
+
+            previous = plan[-1] if plan else None
+
+            if (
+                previous
+                and previous.kind == "send-keys"
+                and previous.target == op.target
+                and previous.args[0] == "-l"
+            ):
+                previous.args[1] += text
+            else:
+                plan.append(
+                    TmuxOp("send-keys", op.target, ["-l", text], op.window, op.pane)
+                )
+
+        self.plan = plan
+
     def parse_shell(self, shell_command=""):
 
         # if only a command or list is specified
@@ -341,13 +841,9 @@ class Ultimux:
 
         return formatted
 
-    def parse_command(self, command, pane, window, target):
+    def get_ssh_options(self, pane, window):
 
         session_config = self.session_config
-        # ---------------------------------------
-        # Get ssh config options
-        # ---------------------------------------
-        ssh_options = {}
 
         # merge these options
         ssh_options1 = {}
@@ -374,51 +870,129 @@ class Ultimux:
             else:
                 ssh_options3 = pane["ssh"]
 
-        ssh_options = {**ssh_options1, **ssh_options2, **ssh_options3}
+        return {**ssh_options1, **ssh_options2, **ssh_options3}
+
+    def get_destination(self, ssh_options):
+
+        if not ssh_options:
+            return ""
+
+        if not ssh_options.get("server"):
+            self.fail("Ssh server must be specified!")
+
+        if ssh_options.get("user"):
+            return "{}@{}".format(ssh_options.get("user"), ssh_options.get("server"))
+
+        return ssh_options.get("server")
+
+    def get_destinations(self):
+
+        session_config = self.session_config
+
+        destinations = []
+
+        for window in session_config["windows"]:
+
+            if window.get("panes"):
+                panes = window["panes"]
+            elif session_config.get("panes"):
+                panes = session_config["panes"]
+            else:
+                panes = [{}]
+
+            if type(panes) != list:
+                continue
+
+            for pane in panes:
+
+                # only dict panes carry their own ssh options
+                if type(pane) != dict:
+                    pane = {}
+
+                destination = self.get_destination(self.get_ssh_options(pane, window))
+
+                if destination and not destination in destinations:
+                    destinations.append(destination)
+
+        return destinations
+
+    def check_connectivity(self):
+
+        if self.debug:
+            return
+
+        destinations = [
+            d for d in self.get_destinations() if not d in self.validated_destinations
+        ]
 
         # ---------------------------------------
-        # Compile ssh commands
+        # Skip recently validated destinations
         # ---------------------------------------
-        if ssh_options:
+        cache = JsonCache("destinations", self.check_cache_ttl)
+
+        if not self.recheck:
+            cached = cache.items()
+            self.validated_destinations.extend(d for d in destinations if d in cached)
+            destinations = [d for d in destinations if not d in cached]
+
+        if not destinations:
+            return
+
+        print("Check ssh connectivity...")
+
+        # with multiplexing the check opens the master connection
+        # which is reused by the panes
+        with span("ssh check", destinations=len(destinations)):
+            results = check_destinations(
+                destinations,
+                self.check_timeout,
+                self.check_workers,
+                self.get_ssh_command_options(),
+            )
 
-            if not ssh_options.get("server"):
-                self.fail("Ssh server must be specified!")
+        failed = []
 
-            if ssh_options.get("user"):
-                destination = "{}@{}".format(
-                    ssh_options.get("user"), ssh_options.get("server")
-                )
+        for destination, (ok, duration) in results.items():
+
+            status = "OK" if ok else "FAIL"
+            print(
+                destination.ljust(60, "."), status.ljust(4), "{:.2f}s".format(duration)
+            )
+
+            if ok:
+                self.validated_destinations.append(destination)
             else:
-                destination = ssh_options.get("server")
+                failed.append(destination)
 
-            options = ["-o ConnectTimeout=0"]
-            options = []
+        cache.update({d: True for d, (ok, _) in results.items() if ok})
 
-            # compile ssh command
-            ssh_command = "ssh {}{}".format(" ".join(options), destination)
+        if failed:
+            self.fail("Failed connectivity check: {}".format(", ".join(failed)))
 
-            # ---------------------------------------
-            # Check connectivity
-            # ---------------------------------------
-            if not destination in self.validated_destinations and not self.debug:
+    def has_pane_options(self):
 
-                # first check
-                if not len(self.validated_destinations):
-                    print("Check ssh connectivity...")
+        return self.tmux_version is None or self.tmux_version >= (3, 1)
 
-                subcommand = "{} {}".format(ssh_command, "echo ok")
-                try:
-                    # split string into pieces
-                    subprocess.check_output(
-                        subcommand.split(), stderr=subprocess.STDOUT
-                    )
-                except subprocess.CalledProcessError as e:
-                    # print(e)
-                    print(destination.ljust(60, "."), "FAIL")
-                    self.fail("Failed connectivity check: {}".format(destination))
+    def parse_command(self, command, pane, window, window_index, pane_index):
 
-                print(destination.ljust(60, "."), "OK")
-                self.validated_destinations.append(destination)
+        target = "{}:{}.{}".format(self.session_name, window_index, pane_index)
+
+        # ---------------------------------------
+        # Get ssh config options
+        # ---------------------------------------
+        ssh_options = self.get_ssh_options(pane, window)
+
+        # ---------------------------------------
+        # Compile ssh commands
+        # ---------------------------------------
+        if ssh_options:
+
+            destination = self.get_destination(ssh_options)
+
+            options = self.get_ssh_command_options()
+
+            # compile ssh command
+            ssh_command = " ".join(["ssh"] + options + [destination])
 
             # ---------------------------------------
             # Ssh remote or login
@@ -431,6 +1005,17 @@ class Ultimux:
             # add ssh prefix to command
             command = "{}{} {}".format(ssh_command, seperator, command)
 
+            # tag the pane with its host for send and gather, pane
+            # options need tmux 3.1
+            if self.has_pane_options():
+                self.add_op(
+                    "set-option",
+                    target,
+                    ["-p", host_option, destination],
+                    window_index,
+                    pane_index,
+                )
+
         # ---------------------------------------
         # String of commands
         # ---------------------------------------
@@ -444,22 +1029,28 @@ class Ultimux:
                 continue
 
             if self.debug:
-                tcommand = "# " + tcommand
-                enter = ""
+                keys = ["# " + tcommand]
             else:
-                enter = "C-m"
+                keys = [tcommand, "C-m"]
 
-            self.tmux_commands.append(
-                "tmux send-keys -t " + target + " '" + tcommand + "' " + enter
-            )
+            self.add_op("send-keys", target, keys, window_index, pane_index)
+
+    def get_plan(self):
+
+        return [op.to_dict() for op in self.plan]
+
+    def out(self, format="text"):
+
+        if format == "json":
+            print(json.dumps(self.get_plan(), indent=2))
+            return
 
-    def out(self):
         print()
 
         for tcomm in self.tmux_commands:
             print(tcomm)
 
-    def exec(self):
+    def exec(self, attach=True):
 
         if self.interactive:
 
@@ -471,5 +1062,140 @@ class Ultimux:
             if answer != "Y" and answer != "":
                 self.fail()
 
-        for subcommand in self.tmux_commands:
-            os.system(subcommand)
+        plan = self.plan
+
+        if not attach:
+            plan = [op for op in plan if op.kind != "attach"]
+
+        if self.executor == "batch":
+            self.exec_batch(plan)
+        elif self.executor == "control":
+            self.exec_control(plan)
+        else:
+            self.exec_single(plan)
+
+    def get_attach_argv(self):
+
+        for op in self.plan:
+            if op.kind == "attach":
+                return op.argv()
+
+        return None
+
+    def exec_attach(self):
+
+        for op in self.plan:
+            if op.kind == "attach":
+                subprocess.call(["tmux"] + op.argv())
+
+    def exec_single(self, plan):
+
+        for op in plan:
+            with span("tmux " + op.kind, target=op.target):
+                subprocess.call(["tmux"] + op.argv())
+
+    @classmethod
+    def exec_batch(cls, plan):
+
+        # attach with a regular client once the session is set up
+        attach = [op for op in plan if op.kind == "attach"]
+        plan = [op for op in plan if op.kind != "attach"]
+
+        if plan:
+            # ---------------------------------------
+            # Source the plan in one tmux client
+            # ---------------------------------------
+            # the server may not run yet, source-file needs one
+            tempfile = lazy_import("tempfile")
+
+            with tempfile.NamedTemporaryFile(
+                "w", prefix="ultimux-", suffix=".tmux"
+            ) as script:
+                script.write(render_script(plan))
+                script.flush()
+
+                with span("tmux batch", commands=len(plan)):
+                    result = subprocess.run(
+                        ["tmux", "start-server", ";", "source-file", script.name],
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        text=True,
+                    )
+
+            # ---------------------------------------
+            # Report failed commands
+            # ---------------------------------------
+            # commands without a marker failed, tmux prints one error
+            # line per failed command in the same order
+            done = set(re.findall(r"^utmx-ok (\d+)$", result.stdout, re.M))
+            errors = [line for line in result.stderr.splitlines() if line.strip()]
+
+            failed = []
+
+            for index, op in enumerate(plan):
+                if str(index) not in done:
+                    output = [errors.pop(0)] if errors else []
+                    failed.append((op, TmuxReply(render_command(op), False, output)))
+
+            # errors without a failed command (e.g. a parse error)
+            if failed and errors:
+                failed[-1][1].output += errors
+
+            cls.report_failed(failed, "tmux")
+
+        for op in attach:
+            subprocess.call(["tmux"] + op.argv())
+
+    def exec_control(self, plan):
+
+        # attach with a regular client once the session is set up
+        attach = [op for op in plan if op.kind == "attach"]
+        plan = [op for op in plan if op.kind != "attach"]
+
+        if not plan:
+            return
+
+        # ---------------------------------------
+        # Open control connection
+        # ---------------------------------------
+        # the first command creates the session, the control client
+        # stays attached to it (no -d) while the other commands run
+        with span("tmux control", commands=len(plan)):
+            if plan[0].kind == "new-session":
+                control = TmuxControl([a for a in plan[0].argv() if a != "-d"])
+                replies = [control.initial]
+                commands = plan[1:]
+            # reconciled sessions already exist
+            else:
+                control = TmuxControl(["attach-session", "-t", self.session_name])
+                replies = []
+                commands = plan
+
+                if not control.initial.ok:
+                    self.fail("Could not attach to {}!".format(self.session_name))
+
+            replies += control.commands([render_command(op) for op in commands])
+            control.close()
+
+        # ---------------------------------------
+        # Report failed commands
+        # ---------------------------------------
+        failed = [(op, r) for op, r in zip(plan, replies) if not r.ok]
+
+        self.report_failed(failed, self.session_name)
+
+        for op in attach:
+            subprocess.call(["tmux"] + op.argv())
+
+    @classmethod
+    def report_failed(cls, failed, default_target):
+
+        for op, reply in failed:
+            target = op.target if op.target else default_target
+
+            print(target.ljust(30, "."), "FAIL", reply.command)
+            for line in reply.output:
+                print(" " * 31, line)
+
+        if failed:
+            cls.fail("Failed to execute {} tmux command(s)!".format(len(failed)))
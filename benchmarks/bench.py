@@ -0,0 +1,312 @@
+#! /usr/bin/env python3
+
+# -----------------------------------------------
+# Ultimux benchmarks
+# -----------------------------------------------
+# Generates synthetic configs and times config loading, inventory
+# grouping, gen session building and plan compilation. tmux and ssh are
+# replaced by stub scripts and HOME points to a scratch dir, so the
+# benchmarks run anywhere and never touch real caches or servers.
+#
+#   ./benchmarks/bench.py --output bench.json
+#   ./benchmarks/bench.py --quick
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.dirname(script_dir)
+
+# -----------------------------------------------
+# Arguments
+# -----------------------------------------------
+parser = argparse.ArgumentParser(description="Ultimux benchmarks.")
+
+parser.add_argument("--output", "-o", help="write json results to this file")
+
+parser.add_argument(
+    "--repeat", "-r", help="runs per benchmark", type=int, default=5, required=False
+)
+
+parser.add_argument(
+    "--quick",
+    help="small sizes for a smoke run",
+    required=False,
+    action="store_true",
+)
+
+args = parser.parse_args()
+
+if args.quick:
+    inventory_sizes = [1000, 5000]
+    session_sizes = [(5, 10)]
+else:
+    inventory_sizes = [10000, 100000]
+    session_sizes = [(10, 10), (50, 40)]
+
+# -----------------------------------------------
+# Sandbox: stub binaries and scratch home
+# -----------------------------------------------
+work_dir = tempfile.mkdtemp(prefix="utmx_bench_")
+bin_dir = os.path.join(work_dir, "bin")
+os.makedirs(bin_dir)
+
+for stub in ["tmux", "ssh"]:
+    stub_path = os.path.join(bin_dir, stub)
+    with open(stub_path, "w") as file:
+        file.write("#!/bin/sh\nexit 0\n")
+    os.chmod(stub_path, 0o755)
+
+os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+os.environ["HOME"] = work_dir
+
+sys.path.insert(0, package_dir)
+
+import _app
+import _ultimux
+
+# fzf selection is replaced by picking the first choices
+selection_size = 50
+
+
+def select_first(choices, multi=False, **kwargs):
+
+    choices = list(choices)
+
+    if multi:
+        return choices[:selection_size]
+
+    return choices[0] if choices else None
+
+
+_app.iterfzf = select_first
+
+
+# -----------------------------------------------
+# Synthetic configs
+# -----------------------------------------------
+def write_run_config(path, windows, panes):
+
+    # ssh options are inherited from session, window and pane level
+    lines = ["bench:", "  ssh:", "    user: root", "    server: host0", "  windows:"]
+
+    for w in range(windows):
+        lines += [f"  - name: win{w}", "    ssh:", f"      server: host{w}"]
+        lines += ["    panes:"]
+
+        for p in range(panes):
+            lines += [
+                f"    - shell: ['echo {w}.{p}; uptime', 'tail -f /var/log/syslog']",
+                "      ssh:",
+                f"        server: host{w}-{p % 8}.example.com",
+            ]
+
+    with open(path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def write_inventory(path, hosts):
+
+    lines = ["hosts:"]
+
+    for h in range(hosts):
+        lines += [
+            f"  - host: host{h}.dc{h % 4}.example.com",
+            f"    description: synthetic host {h}",
+            f"    groups: [group{h % 50}, dc{h % 4}]",
+        ]
+
+    lines += ["dirs:", "  - group_match: ['group1*']", "    paths: [/var/log, /etc]"]
+
+    with open(path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def app_args(subcommand, config_file, **kwargs):
+
+    defaults = {
+        "subcommand": subcommand,
+        "config_file": config_file,
+        "debug": False,
+        "dir": None,
+        "flatten": True,
+        "group_match": None,
+        "host_match": None,
+        "shell": "uptime",
+        "sync": False,
+        "tiled": False,
+        "panes_per_window": 9,
+        "group_windows": False,
+        "save_config": None,
+        "output": None,
+    }
+    defaults.update(kwargs)
+
+    return argparse.Namespace(**defaults)
+
+
+# -----------------------------------------------
+# Measure
+# -----------------------------------------------
+results = []
+
+
+def bench(name, setup, func, **params):
+
+    timings = []
+
+    # keep progress output of the code under test out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+
+        for _ in range(args.repeat):
+            state = setup()
+            start = time.perf_counter()
+            func(state)
+            timings.append(time.perf_counter() - start)
+
+        # separate run for the memory peak, tracing slows down the code
+        state = setup()
+        tracemalloc.start()
+        func(state)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result = {
+        "name": name,
+        "params": params,
+        "min_s": min(timings),
+        "median_s": statistics.median(timings),
+        "peak_kib": peak // 1024,
+    }
+    results.append(result)
+
+    print(
+        name.ljust(30),
+        json.dumps(params).ljust(34),
+        "{:10.4f}s".format(result["median_s"]),
+        "{:10d} KiB".format(result["peak_kib"]),
+    )
+
+
+def clear_yaml_cache():
+
+    cache_dir = os.path.join(work_dir, ".ultimux", "cache", "yaml")
+
+    for entry in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+        os.unlink(os.path.join(cache_dir, entry))
+
+
+for hosts in inventory_sizes:
+
+    inventory = os.path.join(work_dir, f"bench{hosts}.gen.yml")
+    write_inventory(inventory, hosts)
+
+    def cold_app(inventory=inventory):
+        clear_yaml_cache()
+        return _app.GenApp(app_args("gen", inventory))
+
+    def warm_app(inventory=inventory):
+        _app.GenApp(app_args("gen", inventory)).read_yaml_config(inventory)
+        return _app.GenApp(app_args("gen", inventory))
+
+    def loaded_app(inventory=inventory):
+        app = warm_app()
+        app.read_yaml_config(inventory)
+        return app
+
+    bench(
+        "read_yaml_config.cold",
+        cold_app,
+        lambda app, inventory=inventory: app.read_yaml_config(inventory),
+        hosts=hosts,
+    )
+    bench(
+        "read_yaml_config.cached",
+        warm_app,
+        lambda app, inventory=inventory: app.read_yaml_config(inventory),
+        hosts=hosts,
+    )
+    bench(
+        "GenApp.get_group_config",
+        loaded_app,
+        lambda app: app.get_group_config(),
+        hosts=hosts,
+    )
+
+    jsonl_inventory = inventory.replace(".yml", ".jsonl")
+    with contextlib.redirect_stdout(io.StringIO()):
+        _app.ConvertApp(
+            app_args("convert", inventory, output=jsonl_inventory)
+        ).convert()
+
+    bench(
+        "GenApp.get_group_config.jsonl",
+        lambda: _app.GenApp(app_args("gen", jsonl_inventory)),
+        lambda app: app.get_group_config(),
+        hosts=hosts,
+    )
+    bench(
+        "GenApp.get_session_config",
+        loaded_app,
+        lambda app: app.get_session_config("bench"),
+        hosts=hosts,
+        selected=selection_size,
+    )
+
+for windows, panes in session_sizes:
+
+    run_config = os.path.join(work_dir, f"bench{windows}x{panes}.run.yml")
+    write_run_config(run_config, windows, panes)
+
+    def ultimux(run_config=run_config, validated=False):
+        app = _app.RunApp(app_args("run", run_config))
+        session_config = app.get_session_configs(["bench"])["bench"]
+        utmx = _ultimux.Ultimux(session_config, "bench")
+        utmx.set_check_cache_ttl(0)
+        # probes fork one stub ssh per destination, create is timed
+        # without them
+        utmx.validated_destinations = utmx.get_destinations() if validated else []
+        return utmx
+
+    bench(
+        "Ultimux.check_connectivity",
+        ultimux,
+        lambda utmx: utmx.check_connectivity(),
+        windows=windows,
+        panes=windows * panes,
+    )
+    bench(
+        "Ultimux.create",
+        lambda ultimux=ultimux: ultimux(validated=True),
+        lambda utmx: utmx.create(),
+        windows=windows,
+        panes=windows * panes,
+    )
+
+# -----------------------------------------------
+# Report
+# -----------------------------------------------
+report = {
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "repeat": args.repeat,
+    "results": results,
+}
+
+if args.output:
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print(f"Write results to {args.output}...")
+
+shutil.rmtree(work_dir)
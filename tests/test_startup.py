@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+
+# -----------------------------------------------
+# Cold start budget
+# -----------------------------------------------
+# ultimux is called from shell aliases, a plain run must not pay for
+# dependencies it does not use. tmux is replaced by a stub script and
+# HOME points to a scratch dir, the budget can be raised for slow
+# machines with ULTIMUX_STARTUP_BUDGET (seconds).
+
+import os
+import re
+import subprocess
+import sys
+import time
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+startup_budget = float(os.environ.get("ULTIMUX_STARTUP_BUDGET", "1.0"))
+
+# only needed by gen, inventories and templates
+lazy_modules = ["jinja2", "natsort", "globre"]
+
+
+def run_plan(tmp_path, importtime=False):
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir(exist_ok=True)
+
+    tmux = bin_dir / "tmux"
+    tmux.write_text("#! /bin/sh\necho 'tmux 3.3a'\n")
+    tmux.chmod(0o755)
+
+    config = tmp_path / "startup.run.yml"
+    config.write_text("startup:\n  panes:\n  - 'echo one'\n  - 'echo two'\n")
+
+    env = dict(
+        os.environ,
+        HOME=str(tmp_path),
+        PATH="{}:{}".format(bin_dir, os.environ.get("PATH", "")),
+        COLUMNS="200",
+        LINES="50",
+    )
+
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += [
+        os.path.join(package_dir, "ultimux.py"),
+        "--no-daemon",
+        "--plan",
+        "run",
+        "-c",
+        str(config),
+        "-s",
+        "startup",
+    ]
+
+    start = time.monotonic()
+    result = subprocess.run(
+        command,
+        cwd=str(tmp_path),
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    duration = time.monotonic() - start
+
+    assert result.returncode == 0, result.stderr
+
+    return result, duration
+
+
+def test_run_skips_lazy_modules(tmp_path):
+
+    result, _ = run_plan(tmp_path, importtime=True)
+
+    # "import time: self [us] | cumulative | imported package"
+    imported = set()
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+\d+ \|\s*([\w.]+)", line)
+        if match:
+            imported.add(match.group(1).split(".")[0])
+
+    assert "yaml" in imported
+    for module in lazy_modules:
+        assert module not in imported, module
+
+
+def test_run_startup_budget(tmp_path):
+
+    # the first run warms the file system cache and writes bytecode
+    run_plan(tmp_path)
+
+    duration = min(run_plan(tmp_path)[1] for _ in range(3))
+
+    assert duration < startup_budget, "{:.3f}s".format(duration)
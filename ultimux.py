@@ -1,18 +1,26 @@
 #! /usr/bin/env python3
 
+# start the clock before anything else is imported
+import _timings
+
+from _timings import lazy_import
+
 import argparse
 import datetime
+import json
 import os
 import sys
+import time
 
 # -----------------------------------------------
 # Include functions
 # -----------------------------------------------
-from _app import *
-from _ultimux import *
+# _app and _ultimux are imported on first use, a client handing its
+# request to the daemon never needs them
+
+_timings.record("import ultimux modules", time.perf_counter() - _timings.started)
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
-script_time = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
 
 # -----------------------------------------------
 # Arguments
@@ -47,11 +55,84 @@ parser.add_argument(
     action="store_true",
 )
 
-# tiled
 parser.add_argument(
-    "--name", help="tmux session name", required=False
+    "--executor",
+    help="run tmux commands in one batched client (default), over a control mode connection or one by one",
+    required=False,
+    choices=["batch", "control", "single"],
+)
+
+parser.add_argument(
+    "--coalesce",
+    help="send all commands of a pane with one send-keys (default: auto, for sessions with many panes)",
+    required=False,
+    choices=["auto", "on", "off"],
+)
+
+# ssh connectivity check
+parser.add_argument(
+    "--check-timeout",
+    help="ssh connectivity check timeout in seconds",
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--check-workers",
+    help="number of concurrent ssh connectivity checks",
+    required=False,
+    type=int,
+)
+
+parser.add_argument(
+    "--reconcile",
+    help="only add missing windows and panes to a running session (use with --name)",
+    required=False,
+    default=False,
+    action="store_true",
+)
+
+parser.add_argument(
+    "--recheck",
+    help="ignore cached ssh connectivity checks",
+    required=False,
+    default=False,
+    action="store_true",
+)
+
+parser.add_argument(
+    "--plan",
+    help="print the compiled tmux plan as json and exit",
+    required=False,
+    default=False,
+    action="store_true",
+)
+
+parser.add_argument(
+    "--timings",
+    help="report import, startup and per phase timings",
+    required=False,
+    default=False,
+    action="store_true",
+)
+
+parser.add_argument(
+    "--trace",
+    help="write a chrome trace (json) of all phases to this file",
+    required=False,
+)
+
+parser.add_argument(
+    "--no-daemon",
+    help="run in this process even when an ultimux daemon is running",
+    required=False,
+    default=False,
+    action="store_true",
 )
 
+# tiled
+parser.add_argument("--name", help="tmux session name", required=False)
+
 # -----------------------------------------------
 # Subparser
 # -----------------------------------------------
@@ -70,7 +151,27 @@ rparser.add_argument(
     required=False,
     default=False,
 )
-rparser.add_argument("-s", "--session", help="select session", required=False)
+rparser.add_argument(
+    "-s",
+    "--session",
+    help="select session, repeat to launch several sessions",
+    required=False,
+    action="append",
+)
+
+rparser.add_argument(
+    "--list",
+    "-l",
+    help="list sessions of all config files (or of the config file) and exit",
+    required=False,
+    action="store_true",
+)
+
+rparser.add_argument(
+    "--attach",
+    help="session to attach to when several are launched (default: first)",
+    required=False,
+)
 
 # -----------------------------------------------
 # Generate with template
@@ -89,6 +190,13 @@ gparser.add_argument(
     const="select",
 )
 
+gparser.add_argument(
+    "--discover",
+    help="with --dir select: also offer directories found on the hosts over ssh",
+    required=False,
+    action="store_true",
+)
+
 gparser.add_argument(
     "--group-match",
     "-g",
@@ -113,15 +221,59 @@ gparser.add_argument(
 )
 gparser.add_argument("--shell", help="remote command to run", required=False)
 
+# window paging
+gparser.add_argument(
+    "--panes-per-window",
+    "-p",
+    help="maximum number of panes per window",
+    required=False,
+    type=int,
+)
+
+gparser.add_argument(
+    "--group-windows",
+    help="put hosts of different groups in separate windows",
+    required=False,
+    action="store_true",
+)
+
+# headless
+gparser.add_argument(
+    "--headless",
+    help="run --shell on all matched hosts over ssh, without tmux and selection",
+    required=False,
+    action="store_true",
+)
+
+gparser.add_argument(
+    "--concurrency",
+    help="headless: number of hosts to run on at a time",
+    required=False,
+    type=int,
+)
+
+gparser.add_argument(
+    "--timeout",
+    help="headless: seconds before a host is given up",
+    required=False,
+    type=int,
+)
+
 # use config
 gparser.add_argument(
     "-c",
     "--config-file",
-    help="config (yaml) file",
+    help="config (yaml or jsonl) file",
     required=False,
     default=False,
 )
 
+gparser.add_argument(
+    "--save-config",
+    help="also write the generated session config as yaml to this file",
+    required=False,
+)
+
 group = gparser.add_argument_group("tmux options")
 # synchronize
 group.add_argument(
@@ -133,42 +285,432 @@ group.add_argument(
     "--tiled", help="spread panes evenly", required=False, action="store_true"
 )
 
-args = parser.parse_args()
+# -----------------------------------------------
+# Convert inventory
+# -----------------------------------------------
+cparser = subparsers.add_parser(
+    "convert", help="Convert a gen (yaml) inventory to json lines"
+)
+
+cparser.add_argument(
+    "-c",
+    "--config-file",
+    help="gen config (yaml) file",
+    required=False,
+    default=False,
+)
+
+cparser.add_argument(
+    "--output",
+    "-o",
+    help="json lines file to write (default: config file with .jsonl extension)",
+    required=False,
+)
 
 # -----------------------------------------------
-# Initiate app
+# Send keys to many panes
 # -----------------------------------------------
-if args.subcommand == "run":
-    app = RunApp(args)
-    config_index = args.session
-elif args.subcommand == "gen":
-    app = GenApp(args)
-    config_index = f"utmx_gen_{script_time}"
-else:
-    sys.exit("Illegal subcommand!")
+sparser = subparsers.add_parser(
+    "send", help="Send a command to matching panes of all sessions"
+)
+
+sparser.add_argument("command", nargs="+", help="command to send")
+
+sparser.add_argument(
+    "--target",
+    "-t",
+    help="(glob) match pane session:window.pane, window as index or name, repeat for several",
+    required=False,
+    action="append",
+)
+
+sparser.add_argument(
+    "--host-match",
+    "-m",
+    help="(glob) match ssh host of the pane",
+    required=False,
+)
+
+sparser.add_argument(
+    "--group-match",
+    "-g",
+    help="(glob) match inventory group of the pane host (see -c)",
+    required=False,
+)
+
+sparser.add_argument(
+    "-c",
+    "--config-file",
+    help="gen config (yaml or jsonl) file for --group-match",
+    required=False,
+    default=False,
+)
+
+sparser.add_argument(
+    "--no-enter",
+    help="do not press enter after the command",
+    required=False,
+    action="store_true",
+)
+
+# -----------------------------------------------
+# Gather pane output
+# -----------------------------------------------
+xparser = subparsers.add_parser(
+    "gather", help="Capture matching panes and group identical output"
+)
+
+xparser.add_argument(
+    "--target",
+    "-t",
+    help="(glob) match pane session:window.pane, window as index or name, repeat for several",
+    required=False,
+    action="append",
+)
+
+xparser.add_argument(
+    "--host-match",
+    "-m",
+    help="(glob) match ssh host of the pane",
+    required=False,
+)
+
+xparser.add_argument(
+    "--group-match",
+    "-g",
+    help="(glob) match inventory group of the pane host (see -c)",
+    required=False,
+)
+
+xparser.add_argument(
+    "-c",
+    "--config-file",
+    help="gen config (yaml or jsonl) file for --group-match",
+    required=False,
+    default=False,
+)
+
+xparser.add_argument(
+    "--lines",
+    "-n",
+    help="also capture this many lines of history",
+    required=False,
+    type=int,
+)
+
+xparser.add_argument(
+    "--raw",
+    help="keep prompts and earlier commands",
+    required=False,
+    action="store_true",
+)
+
+# -----------------------------------------------
+# Daemon
+# -----------------------------------------------
+dparser = subparsers.add_parser(
+    "daemon", help="Keep configs, inventories and checks warm for fast launches"
+)
+
+dparser.add_argument("action", choices=["start", "stop", "status"])
+
+dparser.add_argument(
+    "--foreground",
+    help="do not detach from the terminal",
+    required=False,
+    action="store_true",
+)
+
+
+# -----------------------------------------------
+# Main
+# -----------------------------------------------
+def main(args, attach=True):
+
+    # when attach is False the attach command is returned, not run
+    if args.timings or args.trace:
+        _timings.enable()
+
+    script_time = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+
+    _app = lazy_import("_app")
+    Ultimux = lazy_import("_ultimux").Ultimux
+
+    # -----------------------------------------------
+    # Initiate app
+    # -----------------------------------------------
+    if args.subcommand == "run":
+        app = _app.RunApp(args)
+
+        if args.list:
+            app.list_sessions()
+            report_timings(args)
+            sys.exit()
+
+        session_configs = app.get_session_configs(args.session)
+    elif args.subcommand == "gen":
+        app = _app.GenApp(args)
+
+        if args.headless:
+            code = app.run_headless()
+            report_timings(args)
+            sys.exit(code)
+
+        config_index = f"utmx_gen_{script_time}"
+        session_configs = {config_index: app.get_session_config(config_index)}
+    elif args.subcommand == "convert":
+        _app.ConvertApp(args).convert()
+        report_timings(args)
+        sys.exit()
+    elif args.subcommand == "send":
+        send(args, _app, Ultimux)
+        report_timings(args)
+        sys.exit()
+    elif args.subcommand == "gather":
+        gather(args, _app, Ultimux)
+        report_timings(args)
+        sys.exit()
+    else:
+        sys.exit("Illegal subcommand!")
+
+    # -----------------------------------------------
+    # Instantiate ultimux classes
+    # -----------------------------------------------
+    if not args.name:
+        tmux_session_name = f"utmx_{args.subcommand}"
+    else:
+        tmux_session_name = args.name
+
+    attach_session = list(session_configs)[0]
+
+    if getattr(args, "attach", None):
+        if args.attach not in session_configs:
+            sys.exit(f"Session {args.attach} is not launched!")
+        attach_session = args.attach
+
+    options = {}
+    for config_type in ["shell", "dir"]:
+
+        if hasattr(args, config_type):
+            options[config_type] = getattr(args, config_type)
+
+    def create_ultimux(config_index, session_config):
+
+        name = tmux_session_name
+
+        # one tmux session per launched config
+        if len(session_configs) > 1:
+            name = f"{tmux_session_name}_{config_index}"
+
+        # reconcile needs a stable session name
+        utmx = Ultimux(session_config, name, not args.reconcile)
+
+        if "check_cache_ttl" in app.app_config:
+            utmx.set_check_cache_ttl(app.app_config["check_cache_ttl"])
+
+        if "coalesce_send_keys" in app.app_config:
+            utmx.set_coalesce(app.app_config["coalesce_send_keys"])
+
+        if "ssh_multiplex" in app.app_config:
+            utmx.set_multiplex(app.app_config["ssh_multiplex"])
+
+        if "ssh_multiplex_persist" in app.app_config:
+            utmx.set_multiplex_persist(app.app_config["ssh_multiplex_persist"])
+
+        for flag in [
+            "check_timeout",
+            "check_workers",
+            "coalesce",
+            "debug",
+            "executor",
+            "interactive",
+            "reconcile",
+            "recheck",
+            "sync",
+            "tiled",
+        ]:
+            if hasattr(args, flag) and getattr(args, flag):
+                func = getattr(utmx, f"set_{flag}")
+                func(getattr(args, flag))
+
+        # only the chosen session is attached
+        utmx.set_attach(config_index == attach_session)
+
+        with _timings.span("create", session=config_index):
+            utmx.create(options)
+
+        return utmx
+
+    def launch_ultimux(config_index, session_config):
+
+        utmx = create_ultimux(config_index, session_config)
+
+        # sessions that are not attached are set up right away
+        if not args.plan and config_index != attach_session:
+            utmx.exec()
+
+        return utmx
+
+    # -----------------------------------------------
+    # Create (and launch) sessions
+    # -----------------------------------------------
+    if len(session_configs) == 1 or args.interactive:
+        utmxs = {k: launch_ultimux(k, c) for k, c in session_configs.items()}
+    else:
+        # ssh checks and tmux setup of all sessions run concurrently
+        with lazy_import("concurrent.futures").ThreadPoolExecutor() as executor:
+            futures = {
+                k: executor.submit(launch_ultimux, k, c)
+                for k, c in session_configs.items()
+            }
+            utmxs = {k: f.result() for k, f in futures.items()}
+
+    if args.plan:
+        for utmx in utmxs.values():
+            utmx.out("json")
+        sys.exit()
+
+    if args.timings or args.trace or not attach:
+        # report before attaching, the attached client runs until detach
+        utmxs[attach_session].exec(attach=False)
+
+        _timings.record("startup until attach", time.perf_counter() - _timings.started)
+
+        report_timings(args)
+
+        if not attach:
+            return utmxs[attach_session].get_attach_argv()
+
+        utmxs[attach_session].exec_attach()
+    else:
+        utmxs[attach_session].exec()
+
+
+def report_timings(args):
+
+    # subcommands without an attach report before they exit
+    if args.timings:
+        _timings.report()
+
+    if args.trace:
+        _timings.write_trace(args.trace)
+        print(f"Write trace to {args.trace}...")
+
+
+def select_panes(args, _app, Ultimux):
+
+    if not (args.target or args.host_match or args.group_match):
+        sys.exit("Select panes with --target, --host-match or --group-match!")
+
+    # hosts of the matching inventory groups
+    hosts = None
+
+    if args.group_match:
+        group_config = _app.GenApp(args).get_group_config()
+        hosts = set(h for group_hosts in group_config.values() for h in group_hosts)
+
+    panes = Ultimux.match_panes(
+        Ultimux.get_panes(), args.target, args.host_match, hosts
+    )
+
+    if not panes:
+        sys.exit("No panes found!")
+
+    return panes
+
+
+def send(args, _app, Ultimux):
+
+    panes = select_panes(args, _app, Ultimux)
+
+    plan = Ultimux.broadcast(panes, " ".join(args.command), not args.no_enter)
+
+    if args.plan:
+        print(json.dumps([op.to_dict() for op in plan], indent=2))
+        return
+
+    print(f"Send to {len(panes)} pane(s)...")
+
+    Ultimux.exec_batch(plan)
+
+
+def gather(args, _app, Ultimux):
+
+    panes = select_panes(args, _app, Ultimux)
+
+    prompt = _app.App(args).app_config.get("gather_prompt", r"^\S*[@:]\S*\s?[$#%>] ?")
+
+    # -----------------------------------------------
+    # Stream first lines as the captures arrive
+    # -----------------------------------------------
+    outputs = {}
+
+    for pane, reply in Ultimux.capture_panes(panes, args.lines):
+
+        label = pane["host"] or pane["target"]
+
+        if not reply.ok:
+            lines = ["capture failed: " + " ".join(reply.output)]
+        elif args.raw:
+            lines = reply.output
+        else:
+            lines = Ultimux.strip_prompt(reply.output, prompt)
+
+        print(label.ljust(50, "."), lines[0][:80] if lines else "")
+
+        outputs.setdefault("\n".join(lines), []).append(label)
+
+    # -----------------------------------------------
+    # Group identical output
+    # -----------------------------------------------
+    for output, labels in sorted(outputs.items(), key=lambda o: -len(o[1])):
+        print()
+        print("{} pane(s): {}".format(len(labels), ", ".join(labels)))
+
+        for line in output.split("\n") if output else ["(no output)"]:
+            print("    " + line)
+
+
+def serve_request(argv):
+
+    # one client request inside the daemon, returns the attach command
+    _timings.reset()
+
+    # connectivity results are shared through the check cache only,
+    # so they expire after check_cache_ttl
+    lazy_import("_ultimux").Ultimux.validated_destinations = []
+
+    return main(parser.parse_args(argv), attach=False)
+
 
 # -----------------------------------------------
-# Instantiate ultimux class
+# Run
 # -----------------------------------------------
-session_config = app.get_session_config(config_index)
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    if args.subcommand == "daemon":
+        daemon = lazy_import("_daemon")
 
-if not args.name:
-    tmux_session_name = f"utmx_{args.subcommand}"
-else:
-    tmux_session_name = args.name
+        if args.action == "start":
+            daemon.start(serve_request, args.foreground)
+        elif args.action == "stop":
+            daemon.stop()
+        else:
+            daemon.status()
 
-utmx = Ultimux(session_config, tmux_session_name, True)
+        sys.exit()
 
-for flag in ["debug", "interactive", "sync", "tiled"]:
-    if hasattr(args, flag) and getattr(args, flag):
-        func = getattr(utmx, f"set_{flag}")
-        func(getattr(args, flag))
+    # hand the request to a running daemon, attach from here, interactive
+    # mode prompts on the terminal and runs in process
+    if not args.no_daemon and not args.interactive:
+        reply = lazy_import("_daemon").request(sys.argv[1:])
 
-options = {}
-for config_type in ["shell", "dir"]:
+        if reply is not None:
+            if reply.get("attach"):
+                os.execvp("tmux", ["tmux"] + reply["attach"])
 
-    if hasattr(args, config_type):
-        options[config_type] = getattr(args, config_type)
+            sys.exit(reply.get("exit", 1))
 
-utmx.create(options)
-utmx.exec()
+    main(args)